@@ -0,0 +1,174 @@
+"""
+Benchmark quick_era5 against a synthetic era5 zarr store, without reaching the public bucket.
+
+Times cold (empty cache) and warm (cache hit) `download_era5_data_from_gcs` calls, cache lookups with many cache
+entries, and converter exports, across request sizes. Each result is printed as a json line with the seconds, the
+throughput and the peak memory, and appended to --output if given, so results can be compared over time.
+
+Usage (from the repository root):
+    python -m benchmarks.run_benchmarks --store memory --latency 0.05 --output bench.jsonl
+"""
+import argparse
+import datetime
+import functools
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from quick_era5 import era5_converter, era5_downloader
+from . import synthetic_era5
+
+utc = datetime.timezone.utc
+store_from_datetime = datetime.datetime(2020, 1, 1)
+
+# request sizes, the datetimes are hours after the first time step of the store
+request_sizes = {
+    'small': {'variable_list': ['2m_temperature'], 'hours': 6, 'level_range': (1000, 0), 'latitude_range': (30, 0), 'longitude_range': (100, 130)},
+    'medium': {'variable_list': ['2m_temperature', 'temperature'], 'hours': 24, 'level_range': (500, 1000), 'latitude_range': (60, -30), 'longitude_range': (60, 180)},
+    'large': {'variable_list': ['temperature', 'geopotential'], 'hours': 24, 'level_range': (200, 1000), 'latitude_range': (90, -90), 'longitude_range': (0, 360)},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark quick_era5 against a synthetic era5 zarr store.')
+    parser.add_argument('--store', choices=['local', 'memory'], default='local', help='Where to put the synthetic store. Default is local.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to sleep before every read of the store. Default is 0.')
+    parser.add_argument('--hours', type=int, default=48, help='Hourly time steps of the synthetic store. Default is 48.')
+    parser.add_argument('--resolution', type=float, default=1.0, help='Grid spacing of the synthetic store in degrees. Default is 1.0.')
+    parser.add_argument('--sizes', nargs='+', choices=list(request_sizes), default=list(request_sizes), help='Request sizes to run.')
+    parser.add_argument('--cache-entries', nargs='+', type=int, default=[100, 1000, 10000], help='Numbers of cache entries for the cache lookup benchmark.')
+    parser.add_argument('--max-workers', type=int, default=1, help='max_workers of the downloads. Default is 1.')
+    parser.add_argument('--work-folder', default=None, help='Folder of the store, the metadata and the caches. Default is a temporary folder.')
+    parser.add_argument('--output', default=None, help='Append the results to this json lines file.')
+    args = parser.parse_args()
+    if args.hours < 24:
+        parser.error('--hours should be at least 24, the store needs a full day before its valid_time_stop')
+
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix='quick_era5_bench_')
+    try:
+        run(args, work_folder)
+    finally:
+        if args.work_folder is None:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+
+def run(args, work_folder):
+    # [make the synthetic store]
+    fs = synthetic_era5.filesystem(args.store)  # no latency while writing
+    store_path = os.path.join(work_folder, 'era5.zarr') if args.store == 'local' else '/quick_era5_bench/era5.zarr'
+    store = synthetic_era5.make_synthetic_era5(fs, store_path, store_from_datetime, args.hours, args.resolution)
+    valid_time_stop = datetime.datetime.fromisoformat(store.attrs['valid_time_stop'])
+    fs.latency = args.latency
+    synthetic_era5.point_downloader_at(era5_downloader, fs, store_path, work_folder)
+    context = {
+        'store': args.store,
+        'latency': args.latency,
+        'resolution': args.resolution,
+        'max_workers': args.max_workers,
+        'commit': _git_commit(),
+        'timestamp': datetime.datetime.now(utc).isoformat(timespec='seconds'),
+    }
+    report = functools.partial(_report, context=context, output=args.output)
+
+    # [benchmarks]
+    for size in args.sizes:
+        request = _request(size, valid_time_stop)
+        _clear_cache()
+        xarr = report('download_cold', size, lambda: era5_downloader.download_era5_data_from_gcs(**request, max_workers=args.max_workers))
+        report('download_warm', size, lambda: era5_downloader.download_era5_data_from_gcs(**request, max_workers=args.max_workers).load())
+        xarr = xarr.load()
+        report('export_netcdf', size, lambda: era5_converter.era5_xarray_to_netcdf(xarr, os.path.join(work_folder, 'export.nc')), xarr.nbytes)
+        report('export_zarr', size, lambda: era5_converter.era5_xarray_to_zarr(xarr, os.path.join(work_folder, 'export.zarr')), xarr.nbytes)
+        variable = request['variable_list'][0]
+        report('export_geotiffs', size, lambda: era5_converter.era5_xarray_to_geotiffs(xarr, variable, os.path.join(work_folder, 'geotiffs')), xarr[variable].nbytes)
+
+    hit_request = _request('small', valid_time_stop)
+    miss_request = dict(hit_request, latitude_range=(-30, -60))
+    for entries in args.cache_entries:
+        _clear_cache()
+        era5_downloader.download_era5_data_from_gcs(**hit_request)
+        _fill_cache(entries - 1)
+        report('cache_hit', f'{entries}_entries', lambda: era5_downloader.download_era5_data_from_gcs(**hit_request).load())
+        checked_miss_request = era5_downloader._check_request(**miss_request)
+        report('cache_miss_lookup', f'{entries}_entries', lambda: era5_downloader._find_covering_cache_entry(checked_miss_request), 0)
+
+
+def _request(size, valid_time_stop):
+    # the requests end at the store's valid_time_stop at the latest, the downloader rejects later times
+    request = dict(request_sizes[size])
+    to_datetime = min(store_from_datetime + datetime.timedelta(hours=request.pop('hours') - 1), valid_time_stop)
+    request['from_datetime'] = store_from_datetime.replace(tzinfo=utc)
+    request['to_datetime'] = to_datetime.replace(tzinfo=utc)
+    return request
+
+
+def _report(benchmark, case, func, nbytes=None, context=None, output=None):
+    """
+    Run func once, print and save its seconds, throughput and peak memory. nbytes defaults to the bytes of the returned dataset.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    _, peak_memory_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    if nbytes is None:
+        nbytes = result.nbytes
+    record = {
+        'benchmark': benchmark,
+        'case': case,
+        'seconds': round(seconds, 6),
+        'bytes': int(nbytes),
+        'mb_per_s': round(nbytes / 1024 ** 2 / seconds, 3) if nbytes else None,
+        'peak_memory_bytes': peak_memory_bytes,
+        **(context or {}),
+    }
+    line = json.dumps(record)
+    print(line, flush=True)
+    if output is not None:
+        with open(output, 'a') as f:
+            f.write(line + '\n')
+    return result
+
+
+def _clear_cache():
+    shutil.rmtree(era5_downloader.cache_era5_folder, ignore_errors=True)
+    os.makedirs(era5_downloader.cache_era5_folder)
+    era5_downloader._manifest_checked_paths.clear()
+    era5_downloader._full_era5.clear()
+
+
+def _fill_cache(entries):
+    """
+    Add cache entries (with empty files) which don't cover the benchmark requests, one per day before the store.
+    """
+    now = time.time()
+    rows = []
+    for i in range(entries):
+        day = store_from_datetime - datetime.timedelta(days=i + 1)
+        cache_name = f"{day:%Y%m%d}00_{day:%Y%m%d}23_1_2m_temperature_0_1000_90_-90_0_360_True"
+        path = os.path.join(era5_downloader.cache_era5_folder, f"{cache_name}.nc")
+        open(path, 'wb').close()
+        rows.append((
+            cache_name, path, 0, now - i, now + 86400,
+            f"{day:%Y%m%d}00", f"{day:%Y%m%d}23", 1, '2m_temperature', 0, 1000, 90, -90, 0, 360, True, '', '',
+        ))
+    columns = era5_downloader._manifest_entry_columns
+    with era5_downloader._manifest_connection() as connection:
+        connection.executemany(f'INSERT OR REPLACE INTO cache_entries ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', rows)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    main()
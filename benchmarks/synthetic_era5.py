@@ -0,0 +1,133 @@
+"""
+A synthetic era5 zarr store with the layout of the ARCO era5 store on GCS, on local disk or in fsspec memory,
+and the file systems to point `era5_downloader` at it, optionally with latency on every read.
+"""
+import datetime
+import fsspec
+import numpy as np
+import os
+import time
+import xarray
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.implementations.memory import MemoryFileSystem
+
+# the levels of the ARCO era5 store
+era5_levels = [1, 2, 3, 5, 7, 10, 20, 30, 50, 70, 100, 125, 150, 175, 200, 225, 250, 300, 350, 400, 450, 500, 550, 600, 650, 700, 750, 775, 800, 825, 850, 875, 900, 925, 950, 975, 1000]
+era5_level_variables = ['geopotential', 'temperature', 'u_component_of_wind', 'v_component_of_wind']
+era5_surface_variables = ['2m_temperature', 'mean_sea_level_pressure', 'total_precipitation']
+
+
+def make_synthetic_era5(
+    fs: fsspec.AbstractFileSystem,
+    path: str,
+    from_datetime: datetime.datetime = datetime.datetime(2020, 1, 1),
+    hours: int = 48,
+    resolution: float = 1.0,
+    levels: list = era5_levels,
+    level_variables: list = era5_level_variables,
+    surface_variables: list = era5_surface_variables,
+) -> xarray.Dataset:
+    """
+    Write a synthetic era5 zarr store with the ARCO layout: dims (time, level, latitude, longitude), latitude from 90 to -90,
+    longitude from 0 to 360, one time step per chunk, and the `valid_time_start`/`valid_time_stop` attributes.
+
+    Args:
+        fs (fsspec.AbstractFileSystem): The file system to write the store to, e.g. local or memory.
+        path (str): The path of the store in the file system.
+        from_datetime (datetime.datetime): The first time step, without timezone. Default is 2020-01-01 00:00.
+        hours (int): Number of hourly time steps. Default is 48.
+        resolution (float): Grid spacing in degrees, the ARCO store is 0.25. Default is 1.0.
+        levels (list): The pressure levels. Default is the 37 levels of the ARCO store.
+        level_variables (list): Variables with a level dim.
+        surface_variables (list): Variables without a level dim.
+
+    Returns:
+        xarray.Dataset: The lazy synthetic dataset which was written.
+    """
+    time_steps = np.datetime64(from_datetime, 'h') + np.arange(hours).astype('timedelta64[h]')
+    latitude = np.linspace(90, -90, int(round(180 / resolution)) + 1)
+    longitude = np.arange(0, 360, resolution)
+    level = np.array(levels, dtype='int64')
+
+    coords = {'time': time_steps.astype('datetime64[ns]'), 'level': level, 'latitude': latitude, 'longitude': longitude}
+    data_vars = {}
+    for name in level_variables:
+        data_vars[name] = (('time', 'level', 'latitude', 'longitude'), _lazy_field((hours, len(level), len(latitude), len(longitude))))
+    for name in surface_variables:
+        data_vars[name] = (('time', 'latitude', 'longitude'), _lazy_field((hours, len(latitude), len(longitude))))
+
+    # like the ARCO store, valid_time_stop is the last day with all 24 hours
+    last_full_day = (from_datetime + datetime.timedelta(hours=hours)).date() - datetime.timedelta(days=1)
+    xarr = xarray.Dataset(data_vars, coords=coords, attrs={
+        'valid_time_start': from_datetime.date().isoformat(),
+        'valid_time_stop': last_full_day.isoformat(),
+    })
+    encoding = {name: {'chunks': (1,) + xarr[name].shape[1:]} for name in xarr.data_vars}
+    xarr.to_zarr(fs.get_mapper(path), mode='w', encoding=encoding, consolidated=True, compute=True)
+    return xarr
+
+
+def _lazy_field(shape):
+    """
+    A random float32 field around 273.15, built one time step at a time by dask when the store is written.
+    """
+    import dask.array
+    rng = dask.array.random.RandomState(0)
+    return rng.standard_normal(shape, chunks=(1,) + shape[1:]).astype('float32') + 273.15
+
+
+class _LatencyMixin:
+    """
+    Sleep `latency` seconds before every read, to imitate the round trip to a remote store.
+    """
+    cachable = False
+    latency = 0.0
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        time.sleep(self.latency)
+        return super().cat_file(path, start=start, end=end, **kwargs)
+
+
+class LatencyLocalFileSystem(_LatencyMixin, LocalFileSystem):
+    pass
+
+
+class LatencyMemoryFileSystem(_LatencyMixin, MemoryFileSystem):
+    pass
+
+
+def point_downloader_at(era5_downloader, fs: fsspec.AbstractFileSystem, store_path: str, work_folder: str) -> None:
+    """
+    Point the era5_downloader at the synthetic store, with the metadata and the caches in work_folder.
+
+    Args:
+        era5_downloader (module): The `quick_era5.era5_downloader` module.
+        fs (fsspec.AbstractFileSystem): The file system of the store, used as `era5_downloader.gcs`.
+        store_path (str): The path of the store in the file system.
+        work_folder (str): The folder of the metadata, the cache and the chunk cache.
+    """
+    era5_downloader.gcs = fs
+    era5_downloader.era5_gcp_path = store_path
+    era5_downloader.local_era5_metadata_at = os.path.join(work_folder, 'asset', 'era5_metadata.json')
+    era5_downloader.cache_era5_folder = os.path.join(work_folder, 'cache', 'era5')
+    era5_downloader.chunk_cache_folder = os.path.join(work_folder, 'cache', 'chunks')
+    era5_downloader.offline_mode = True  # the synthetic store never gets new data
+    era5_downloader._era5_metadata = None
+    era5_downloader._full_era5.clear()
+    os.makedirs(era5_downloader.cache_era5_folder, exist_ok=True)
+
+
+def filesystem(store: str, latency: float = 0.0) -> fsspec.AbstractFileSystem:
+    """
+    Args:
+        store (str): 'local' or 'memory'.
+        latency (float): Seconds to sleep before every read. Default is 0.
+    """
+    if store == 'local':
+        fs = LatencyLocalFileSystem()
+    elif store == 'memory':
+        fs = LatencyMemoryFileSystem()
+    else:
+        raise ValueError(f"store should be 'local' or 'memory', but got {store}")
+    fs.latency = latency
+    return fs
@@ -1,8 +1,14 @@
+import importlib.util
+import time
+
+_import_started = time.perf_counter()
 from . import era5_converter
 from . import era5_downloader
+from . import era5_metrics
 
-# check netCDF4's availability
-try:
-    import netCDF4
-except ImportError:
+# check netCDF4's availability, without importing it until it's used
+if importlib.util.find_spec('netCDF4') is None:
     raise ImportError("netCDF4 is not installed, please install it by running 'pip install netCDF4'.")
+
+# the dependencies are imported on first use, their import seconds are added to `era5_metrics.import_seconds` then
+era5_metrics.count_import('quick_era5', time.perf_counter() - _import_started)
@@ -0,0 +1,249 @@
+"""
+Command line entry point of quick_era5, to warm the cache with many downloads in parallel.
+
+A job spec (yaml or json) lists the variables, the time windows, the boxes and the levels to download:
+
+    variables: [2m_temperature, temperature]
+    level_range: [500, 1000]            # optional, default all levels
+    time_interval: 1                    # optional, default 1 hour
+    time_windows:
+      - {from: '2023-01-01T00:00:00Z', to: '2023-03-31T23:00:00Z'}
+    boxes:                              # optional, default the whole globe
+      - {latitude_range: [60, 0], longitude_range: [90, 150]}
+    unit_hours: 24                      # optional, hours of each work unit, or 'month', default 24
+    options: {longitude_shift: true}    # optional, more arguments of `download_era5_data_from_gcs`
+
+Each time window is split into work units at multiples of unit_hours from 1970-01-01 00:00 UTC (or at calendar
+months), so that the same hours always fall in the same unit and the same cache file, and each unit is downloaded
+for each box. The units are run on a process pool, each download fetching with a thread pool. The finished units
+are written to a state file after each unit, so an interrupted job skips them when it is run again.
+
+Usage (from the folder containing quick_era5):
+    python -m quick_era5 warm job.yaml --processes 4 --threads 8
+    python -m quick_era5 status job.yaml
+"""
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import sys
+import time
+from . import era5_downloader
+
+utc = datetime.timezone.utc
+_epoch = datetime.datetime(1970, 1, 1, tzinfo=utc)
+
+# arguments of `download_era5_data_from_gcs` set from the job spec keys and the command line, not from options
+_runner_arguments = ('variable_list', 'from_datetime', 'to_datetime', 'time_interval', 'level_range', 'latitude_range', 'longitude_range', 'max_workers')
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m quick_era5', description='Warm the quick_era5 cache from a job spec.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    warm_parser = subparsers.add_parser('warm', help='Download the work units of the job spec into the cache, skipping the finished ones.')
+    warm_parser.add_argument('job_spec', help='The yaml or json job spec.')
+    warm_parser.add_argument('--state', default=None, help='The json state file of the job. Default is {job_spec}.state.json.')
+    warm_parser.add_argument('--processes', type=int, default=1, help='Work units downloaded at the same time, each in its own process. Default is 1.')
+    warm_parser.add_argument('--threads', type=int, default=1, help='Threads fetching the chunks of each work unit (max_workers). Default is 1.')
+
+    status_parser = subparsers.add_parser('status', help='Show the progress of the job.')
+    status_parser.add_argument('job_spec', help='The yaml or json job spec.')
+    status_parser.add_argument('--state', default=None, help='The json state file of the job. Default is {job_spec}.state.json.')
+
+    args = parser.parse_args(argv)
+    spec = load_job_spec(args.job_spec)
+    units = split_job_spec(spec)
+    state_path = args.state or f"{args.job_spec}.state.json"
+    state = _load_state(state_path, _spec_hash(spec))
+
+    if args.command == 'status':
+        finished = sum(1 for unit_id in units if state['units'].get(unit_id, {}).get('status') == 'done')
+        failed = sum(1 for unit_id in units if state['units'].get(unit_id, {}).get('status') == 'failed')
+        print(f"{finished}/{len(units)} work units done, {failed} failed, {len(units) - finished - failed} to do")
+        return 0
+
+    if args.processes <= 0 or args.threads <= 0:
+        parser.error('--processes and --threads should be positive integers')
+    return warm(units, state, state_path, args.processes, args.threads)
+
+
+def load_job_spec(path: str) -> dict:
+    """
+    Read the yaml or json job spec, see the module docstring for its keys.
+    """
+    with open(path) as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("pyyaml is not installed, please install it by running 'pip install pyyaml', or use a json job spec.")
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    _job_spec_should_be_valid(spec)
+    return spec
+
+
+def split_job_spec(spec: dict) -> dict:
+    """
+    Split the job spec into work units.
+
+    Returns:
+        dict: unit id -> keyword arguments of `download_era5_data_from_gcs`, in the order to run them.
+    """
+    time_interval = spec.get('time_interval', 1)
+    unit_hours = spec.get('unit_hours', 24)
+    boxes = spec.get('boxes') or [{'latitude_range': (90, -90), 'longitude_range': (0, 360)}]
+    units = {}
+    for window in spec['time_windows']:
+        for from_datetime, to_datetime in _split_time_window(_parse_datetime(window['from']), _parse_datetime(window['to']), time_interval, unit_hours):
+            for box in boxes:
+                kwargs = {
+                    'variable_list': list(spec['variables']),
+                    'from_datetime': from_datetime,
+                    'to_datetime': to_datetime,
+                    'time_interval': time_interval,
+                    'latitude_range': tuple(box['latitude_range']),
+                    'longitude_range': tuple(box['longitude_range']),
+                    **spec.get('options', {}),
+                }
+                if 'level_range' in spec:
+                    kwargs['level_range'] = tuple(spec['level_range']) if isinstance(spec['level_range'], list) else spec['level_range']
+                unit_id = f"{from_datetime:%Y%m%d%H}_{to_datetime:%Y%m%d%H}_{kwargs['latitude_range'][0]}_{kwargs['latitude_range'][1]}_{kwargs['longitude_range'][0]}_{kwargs['longitude_range'][1]}"
+                units[unit_id] = kwargs
+    return units
+
+
+def warm(units: dict, state: dict, state_path: str, processes: int, threads: int) -> int:
+    """
+    Download the unfinished work units on a process pool, saving the state after each unit.
+
+    Returns:
+        int: The exit code, 1 if any work unit failed.
+    """
+    todo = [unit_id for unit_id in units if state['units'].get(unit_id, {}).get('status') != 'done']
+    finished = len(units) - len(todo)
+    print(f"{finished}/{len(units)} work units done, {len(todo)} to do", flush=True)
+
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(_run_unit, units[unit_id], threads): unit_id for unit_id in todo}
+        for future in concurrent.futures.as_completed(futures):
+            unit_id = futures[future]
+            try:
+                seconds = future.result()
+                state['units'][unit_id] = {'status': 'done', 'seconds': round(seconds, 3)}
+                finished += 1
+                print(f"[{finished}/{len(units)}] {unit_id} done in {seconds:.1f} s", flush=True)
+            except Exception as e:
+                state['units'][unit_id] = {'status': 'failed', 'error': repr(e)}
+                failed += 1
+                print(f"[{finished}/{len(units)}] {unit_id} failed: {e!r}", file=sys.stderr, flush=True)
+            _save_state(state_path, state)
+
+    print(f"{finished}/{len(units)} work units done, {failed} failed", flush=True)
+    return 1 if failed else 0
+
+
+# [sub functions]
+def _run_unit(kwargs, threads):
+    """
+    Download one work unit into the cache, runs in the worker processes of `warm`.
+    """
+    start = time.perf_counter()
+    era5_downloader.download_era5_data_from_gcs(**kwargs, max_workers=threads)
+    return time.perf_counter() - start
+
+
+def _split_time_window(from_datetime, to_datetime, time_interval, unit_hours):
+    """
+    Split the time steps of the window into units ending before the multiples of unit_hours from 1970-01-01 00:00 UTC.
+
+    Returns:
+        list of tuple: (first time step, last time step) of each unit.
+    """
+    if unit_hours == 'month':
+        return era5_downloader._split_time_blocks(from_datetime, to_datetime, time_interval, 'month')
+
+    interval = datetime.timedelta(hours=time_interval)
+    unit = datetime.timedelta(hours=unit_hours)
+    last_step = from_datetime + (to_datetime - from_datetime) // interval * interval
+    units = []
+    start = from_datetime
+    while start <= last_step:
+        unit_end = _epoch + ((start - _epoch) // unit + 1) * unit
+        steps = -((start - unit_end) // interval)  # steps before unit_end, ceil
+        units.append((start, min(start + (steps - 1) * interval, last_step)))
+        start += steps * interval
+    return units
+
+
+def _parse_datetime(value):
+    """
+    A datetime of the job spec, an iso string or a datetime parsed by yaml, UTC if it has no timezone.
+    """
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if not isinstance(value, datetime.datetime):
+        raise ValueError(f"the times of time_windows should be iso datetime strings, but got {value}")
+    if value.tzinfo is None:
+        return value.replace(tzinfo=utc)
+    return value.astimezone(utc)
+
+
+def _spec_hash(spec):
+    return hashlib.sha1(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _load_state(state_path, spec_hash):
+    """
+    Read the state file, or start a new state if it doesn't exist or was made for another job spec.
+    """
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        if state.get('spec_hash') == spec_hash:
+            return state
+        print(f"{state_path} was made for another job spec, starting over", file=sys.stderr)
+    return {'spec_hash': spec_hash, 'units': {}}
+
+
+def _save_state(state_path, state):
+    # write to a temporary file and rename it, so that an interrupted job never leaves a half-written state
+    temp_path = f"{state_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(temp_path, state_path)
+
+
+def _job_spec_should_be_valid(spec):
+    if not isinstance(spec, dict):
+        raise ValueError(f"the job spec should be a mapping, but got {type(spec).__name__}")
+    for key in ('variables', 'time_windows'):
+        if key not in spec:
+            raise ValueError(f"the job spec should have '{key}'")
+    if not isinstance(spec['variables'], list) or len(spec['variables']) == 0:
+        raise ValueError(f"variables should be a non-empty list, but got {spec['variables']}")
+    if not isinstance(spec['time_windows'], list) or not all(isinstance(window, dict) and 'from' in window and 'to' in window for window in spec['time_windows']):
+        raise ValueError(f"time_windows should be a list of {{from: ..., to: ...}}, but got {spec['time_windows']}")
+    for box in spec.get('boxes') or []:
+        if not isinstance(box, dict) or 'latitude_range' not in box or 'longitude_range' not in box:
+            raise ValueError(f"boxes should be a list of {{latitude_range: ..., longitude_range: ...}}, but got {box}")
+    unit_hours = spec.get('unit_hours', 24)
+    if unit_hours != 'month' and (not isinstance(unit_hours, int) or isinstance(unit_hours, bool) or unit_hours <= 0):
+        raise ValueError(f"unit_hours should be a positive integer or 'month', but got {unit_hours}")
+    options = spec.get('options', {})
+    if not isinstance(options, dict):
+        raise ValueError(f"options should be a mapping, but got {options}")
+    runner_options = [key for key in options if key in _runner_arguments]
+    if runner_options:
+        raise ValueError(f"options should not have {runner_options}, they are set by the job spec keys and --threads")
+    if options.get('lazy'):
+        raise ValueError("options should not have lazy: true, a lazy download doesn't fill the cache")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
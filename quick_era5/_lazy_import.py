@@ -0,0 +1,37 @@
+import importlib
+import threading
+import time
+import types
+from . import era5_metrics
+
+_import_lock = threading.Lock()
+
+
+class _LazyModule(types.ModuleType):
+    """
+    Stand-in for a module which is imported on the first attribute access, e.g. `xarray.open_zarr`.
+
+    After the import, the attributes of the module are copied into the stand-in, so the later accesses cost the same
+    as with the module itself.
+    """
+    def __getattr__(self, name):
+        with _import_lock:
+            start = time.perf_counter()
+            module = importlib.import_module(self.__name__)
+            if self.__name__ not in era5_metrics.import_seconds:
+                era5_metrics.count_import(self.__name__, time.perf_counter() - start)
+            self.__dict__.update(module.__dict__)
+        return getattr(module, name)
+
+
+def lazy_import(module_name: str) -> types.ModuleType:
+    """
+    Import the module on first use instead of now, so that `import quick_era5` doesn't pay for xarray, gcsfs,
+    rasterio, ... until they are needed.
+
+    Args:
+        module_name (str): The module name, e.g. 'xarray' or 'numpy'.
+    Returns:
+        types.ModuleType: The stand-in of the module.
+    """
+    return _LazyModule(module_name)
@@ -1,18 +1,31 @@
-from affine import Affine
+from __future__ import annotations
+
+import concurrent.futures
 import datetime
-import numpy as np
-import pandas as pd
-import rasterio
-import xarray
+import os
+from . import era5_metrics
+from ._lazy_import import lazy_import
+
+# the dependencies are imported on first use, so that `import quick_era5` is fast
+affine = lazy_import('affine')
+np = lazy_import('numpy')
+rasterio = lazy_import('rasterio')
+xarray = lazy_import('xarray')
 
 
-def era5_xarray_to_netcdf(xarr: xarray.core.dataset.Dataset, save_at: str) -> None:
+@era5_metrics.instrument
+def era5_xarray_to_netcdf(xarr: xarray.core.dataset.Dataset, save_at: str, chunk_layout: str | None = None, codec: str | None = None, compression_level: int = 4, packing: str | dict | None = None, max_error: float | dict | None = None) -> None:
     """
     Save the xarray dataset to a netcdf file.
 
     Args:
         xarr, xarray.core.dataset.Dataset, the xarray dataset to save.
         file_path, str, the file path to save the xarray dataset.
+        chunk_layout, str or None, 'map' for reading whole maps, 'timeseries' for reading long time series of small areas, None for the netCDF4 default.
+        codec, str or None, 'zlib', 'zstd' or 'blosc' to compress the data, None for no compression.
+        compression_level, int, the compression level of the codec.
+        packing, str or dict or None, 'int16' to pack the data with scale_factor and add_offset, or a dict of variable -> 'int16' or None, None for no packing.
+        max_error, float or dict or None, the largest absolute error allowed by packing, or a dict of variable -> max error, a variable is not packed if packing can't keep the error within it.
     Returns:
         None
     """
@@ -24,11 +37,112 @@ def era5_xarray_to_netcdf(xarr: xarray.core.dataset.Dataset, save_at: str) -> No
     if not save_at.lower().endswith(".nc"):
         raise ValueError("The input save_at should be a '.nc' file.")
 
-    xarr.to_netcdf(save_at)
+    encoding = era5_storage_encoding(xarr, 'netcdf', chunk_layout, codec, compression_level, packing, max_error)
+    with era5_metrics.phase('write'):
+        xarr.to_netcdf(save_at, encoding=encoding)
+    era5_metrics.count('files_written')
+    return None
+
+
+@era5_metrics.instrument
+def era5_xarray_to_zarr(xarr: xarray.core.dataset.Dataset, save_at: str, chunk_layout: str | None = 'map', codec: str | None = 'zstd', compression_level: int = 3, packing: str | dict | None = None, max_error: float | dict | None = None) -> None:
+    """
+    Save the xarray dataset to a zarr folder, which can be read partially.
+
+    Args:
+        xarr, xarray.core.dataset.Dataset, the xarray dataset to save.
+        save_at, str, the folder path to save the xarray dataset, overwritten if exists.
+        chunk_layout, str or None, 'map' for reading whole maps, 'timeseries' for reading long time series of small areas, None for one chunk per variable.
+        codec, str or None, 'zlib', 'zstd' or 'blosc' to compress the data, None for no compression.
+        compression_level, int, the compression level of the codec.
+        packing, str or dict or None, 'int16' or 'float16', or a dict of variable -> 'int16', 'float16' or None, None for no packing.
+        max_error, float or dict or None, the largest absolute error allowed by packing, or a dict of variable -> max error, a variable is not packed if packing can't keep the error within it.
+    Returns:
+        None
+    """
+    # check
+    if not isinstance(xarr, xarray.core.dataset.Dataset):
+        raise ValueError("The input xarr should be an xarray dataset.")
+    if not isinstance(save_at, str):
+        raise ValueError("The input save_at should be a string.")
+    if not save_at.lower().endswith(".zarr"):
+        raise ValueError("The input save_at should be a '.zarr' folder.")
+
+    encoding = era5_storage_encoding(xarr, 'zarr', chunk_layout, codec, compression_level, packing, max_error)
+    with era5_metrics.phase('write'):
+        xarr.to_zarr(save_at, mode='w', encoding=encoding)
+    era5_metrics.count('files_written')
     return None
 
 
-def era5_xarray_to_geotiff(xarr: xarray.core.dataset.Dataset, variable: str, z: int | float, time: datetime.datetime, save_at: str) -> None:
+def era5_storage_encoding(xarr: xarray.core.dataset.Dataset, file_format: str, chunk_layout: str | None, codec: str | None, compression_level: int, packing: str | dict | None = None, max_error: float | dict | None = None) -> dict:
+    """
+    Build the encoding of the data variables for saving the xarray dataset to netcdf or zarr.
+
+    Packing stores float variables in fewer bytes, xarray decodes them back to floats when reading:
+    'int16' maps the range of the variable to int16 with scale_factor and add_offset (CF convention), the error is
+    at most half of scale_factor; 'float16' (zarr only) keeps about 3 significant digits and values up to 65504.
+    A variable is stored unpacked if the packed error could exceed its max_error, or if it doesn't fit in float16.
+
+    Args:
+        xarr, xarray.core.dataset.Dataset, the xarray dataset to save.
+        file_format, str, 'netcdf' or 'zarr'.
+        chunk_layout, str or None, 'map' (one chunk per time and level), 'timeseries' (all times of 32x32 grid points per chunk) or None.
+        codec, str or None, 'zlib', 'zstd' or 'blosc', None for no compression.
+        compression_level, int, the compression level of the codec.
+        packing, str or dict or None, None, 'int16' or 'float16' for all the variables, or a dict of variable -> packing.
+        max_error, float or dict or None, the largest absolute error allowed by packing for all the variables, or a dict of variable -> max error, None for no limit.
+    Returns:
+        dict, the encoding to pass to `to_netcdf` or `to_zarr`.
+    """
+    # check
+    if file_format not in ('netcdf', 'zarr'):
+        raise ValueError(f"The input file_format should be 'netcdf' or 'zarr', but got {file_format}.")
+    if chunk_layout not in (None, 'map', 'timeseries'):
+        raise ValueError(f"The input chunk_layout should be None, 'map' or 'timeseries', but got {chunk_layout}.")
+    if codec not in (None, 'zlib', 'zstd', 'blosc'):
+        raise ValueError(f"The input codec should be None, 'zlib', 'zstd' or 'blosc', but got {codec}.")
+    if not isinstance(compression_level, int):
+        raise ValueError("The input compression_level should be an integer.")
+    packings = set(packing.values()) if isinstance(packing, dict) else {packing}
+    if not packings <= {None, 'int16', 'float16'}:
+        raise ValueError(f"The input packing should be None, 'int16' or 'float16', or a dict of them, but got {packing}.")
+    if file_format == 'netcdf' and 'float16' in packings:
+        raise ValueError("The input packing 'float16' is only for zarr, netcdf has no float16 type.")
+
+    encoding = {}
+    for name, variable in xarr.data_vars.items():
+        variable_encoding = {}
+
+        # chunks
+        if chunk_layout is None:
+            chunks = variable.shape
+        else:
+            chunks = tuple(_layout_chunk_size(dim, size, chunk_layout) for dim, size in variable.sizes.items())
+        if file_format == 'zarr':
+            variable_encoding['chunks'] = chunks
+        elif chunk_layout is not None:
+            variable_encoding['chunksizes'] = chunks
+
+        # compression
+        if file_format == 'zarr':
+            variable_encoding['compressor'] = _zarr_compressor(codec, compression_level)
+        elif codec == 'zlib':
+            variable_encoding.update({'zlib': True, 'complevel': compression_level})
+        elif codec is not None:
+            variable_encoding.update({'compression': {'zstd': 'zstd', 'blosc': 'blosc_lz4'}[codec], 'complevel': compression_level})
+
+        # packing
+        variable_packing = packing.get(name) if isinstance(packing, dict) else packing
+        variable_max_error = max_error.get(name) if isinstance(max_error, dict) else max_error
+        variable_encoding.update(_packing_encoding(variable, variable_packing, variable_max_error))
+
+        encoding[name] = variable_encoding
+    return encoding
+
+
+@era5_metrics.instrument
+def era5_xarray_to_geotiff(xarr: xarray.core.dataset.Dataset, variable: str, z: int | float, time: datetime.datetime, save_at: str, cog: bool = False, compression: str | None = 'deflate', blocksize: int = 256, overview_resampling: str = 'average') -> None:
     """
     Save the specified variable, pressure level, time data in the xarray dataset to a geotiff file.
 
@@ -38,6 +152,10 @@ def era5_xarray_to_geotiff(xarr: xarray.core.dataset.Dataset, variable: str, z:
         z: int or float or None, the z level to save, if data has only one level, use None.
         time: datetime.datetime, the time to save, if timezone is None, it will be converted to UTC.
         save_at: str, the file path to save geotiff file.
+        cog: bool, if True, save a cloud optimized geotiff with internal tiles and overviews, so that a tile server reads only the tiles and the overview it needs.
+        compression: str or None, 'deflate', 'zstd' or 'lzw' to compress the cloud optimized geotiff, None for no compression. Ignored if cog is False.
+        blocksize: int, the width and height of the tiles of the cloud optimized geotiff, a multiple of 16. Ignored if cog is False.
+        overview_resampling: str, the resampling of the overviews, e.g. 'average', 'nearest' or 'bilinear'. Ignored if cog is False.
 
     Returns:
         None
@@ -80,9 +198,7 @@ def era5_xarray_to_geotiff(xarr: xarray.core.dataset.Dataset, variable: str, z:
         raise ValueError(f"The input z({z}) should be in the xarray dataset, available levels: {available_levels}")
 
     # time should be in the xarr
-    available_times = list(map(lambda x: (pd.to_datetime(x).to_pydatetime().replace(tzinfo=datetime.timezone.utc)), list(xarr.time.values)))
-    if time not in available_times:
-        raise ValueError(f"The input time {time} should be in the xarray dataset, available times: {available_times}")
+    _time_should_be_in_xarr(xarr, time)
 
     # save_at should be a string
     if not isinstance(save_at, str):
@@ -92,6 +208,9 @@ def era5_xarray_to_geotiff(xarr: xarray.core.dataset.Dataset, variable: str, z:
     if not save_at.lower().endswith(".tif") and not save_at.lower().endswith(".tiff"):
         raise ValueError("The input save_at should be a '.tif' or '.tiff' file.")
 
+    # cog options should be valid
+    cog_options = _cog_options(cog, compression, blocksize, overview_resampling)
+
     # [get data array]
     variable = variable
     time = np.datetime64(time.replace(tzinfo=None))
@@ -101,49 +220,112 @@ def era5_xarray_to_geotiff(xarr: xarray.core.dataset.Dataset, variable: str, z:
         level = int(z)
         array = xarr[variable].sel(level=level, time=time).values
 
-    # get lat lon info
-    lat_list = list(xarr.latitude.values)
-    lon_list = list(xarr.longitude.values)
-    delta_lat = abs(lat_list[1] - lat_list[0])
-    delta_lon = abs(lon_list[1] - lon_list[0])
-
+    # get georeference info
     # longitude is from 0 to 360 originally, we need to convert it to -180 to 180
-    try:
-        lon_greater_than_180 = [i for i, lon in enumerate(lon_list) if lon >= 180][0]
-        lon_list = lon_list[lon_greater_than_180:] + lon_list[:lon_greater_than_180]
-        lon_list = [lon - 360 if lon >= 180 else lon for lon in lon_list]
-        array = np.concatenate((array[:, lon_greater_than_180:], array[:, :lon_greater_than_180]), axis=1)
-    except IndexError:
-        pass
-
-    # calculate georeference info
-    north = lat_list[0] + delta_lat / 2
-    west = lon_list[0] - delta_lon / 2
-    delta_x = delta_lon
-    delta_y = delta_lat
-    height = array.shape[0]
-    width = array.shape[1]
-    transform = Affine(delta_x, 0, west, 0, -delta_y, north)
-    crs = rasterio.crs.CRS.from_epsg(4326)
+    lon_order, transform = _geotiff_georeference(xarr)
+    if lon_order is not None:
+        array = array[:, lon_order]
 
     # save
-    with rasterio.open(
-        save_at,
-        mode="w",
-        driver="GTiff",
-        height=height,
-        width=width,
-        count=1,
-        dtype=np.float32,
-        nodata=np.nan,
-        crs=crs,
-        transform=transform,
-    ) as dst:
-        dst.write(array, 1)
+    with era5_metrics.phase('write'):
+        _write_geotiff(save_at, array[np.newaxis], transform, cog_options=cog_options)
+    era5_metrics.count('files_written')
 
     return None
 
 
+@era5_metrics.instrument
+def era5_xarray_to_geotiffs(xarr: xarray.core.dataset.Dataset, variable: str | list | None, save_folder: str, per_time_step: bool = False, max_workers: int = 1, cog: bool = False, compression: str | None = 'deflate', blocksize: int = 256, overview_resampling: str = 'average') -> list:
+    """
+    Save all the times and levels of the specified variables in the xarray dataset to geotiff files in one pass.
+
+    By default, one multi-band geotiff is saved for each variable and level, with one band for each time, named
+    '{variable}_{level}.tif' ('{variable}.tif' if the data has only one level). The band descriptions are the times.
+    If per_time_step is True, one geotiff is saved for each time and level, named '{variable}_{level}_{YYYYmmddHH}.tif'.
+
+    Args:
+        xarr: xarray.core.dataset.Dataset, the xarray dataset to save.
+        variable: str or list or None, the variable or the variables to save, None for all the variables.
+        save_folder: str, the folder to save the geotiff files, created if not exists.
+        per_time_step: bool, if True, save one file for each time step instead of one multi-band file for each level.
+        max_workers: int, the number of processes writing the files at the same time.
+        cog: bool, if True, save cloud optimized geotiffs with internal tiles and overviews, see `era5_xarray_to_geotiff`.
+        compression: str or None, 'deflate', 'zstd' or 'lzw' to compress the cloud optimized geotiffs, None for no compression. Ignored if cog is False.
+        blocksize: int, the width and height of the tiles of the cloud optimized geotiffs, a multiple of 16. Ignored if cog is False.
+        overview_resampling: str, the resampling of the overviews, e.g. 'average', 'nearest' or 'bilinear'. Ignored if cog is False.
+
+    Returns:
+        list, the file paths of the saved geotiff files.
+    """
+    # [check input]
+    # the input is checked once for all the files
+    if not isinstance(xarr, xarray.core.dataset.Dataset):
+        raise ValueError("The input xarr should be an xarray dataset.")
+    available_variables = list(xarr.data_vars)
+    variables = available_variables if variable is None else [variable] if isinstance(variable, str) else variable
+    if not isinstance(variables, list) or not all(isinstance(name, str) for name in variables):
+        raise ValueError("The input variable should be a string, a list of strings or None.")
+    for name in variables:
+        if name not in available_variables:
+            raise ValueError(f"The input variable({name}) should be in the xarray dataset, available variables: {available_variables}")
+    if not isinstance(save_folder, str):
+        raise ValueError("The input save_folder should be a string.")
+    if not isinstance(max_workers, int) or max_workers <= 0:
+        raise ValueError("The input max_workers should be a positive integer.")
+    cog_options = _cog_options(cog, compression, blocksize, overview_resampling)
+    os.makedirs(save_folder, exist_ok=True)
+
+    # [get georeference info]
+    # the longitude order is calculated once for all the files
+    lon_order, transform = _geotiff_georeference(xarr)
+    transform_coefficients = (transform.a, transform.b, transform.c, transform.d, transform.e, transform.f)  # Affine can't be pickled to the workers
+    times = xarr.indexes['time']
+    time_descriptions = [t.strftime('%Y-%m-%dT%H:%M:%SZ') for t in times]
+
+    # [list the files to write]
+    # each job is (file path, variable, level index, time index or None for all times)
+    jobs = []
+    data_arrays = {}
+    for name in variables:
+        data_array = xarr[name]
+        has_level = 'level' in data_array.dims
+        data_arrays[name] = data_array.transpose('time', 'level', 'latitude', 'longitude') if has_level else data_array.transpose('time', 'latitude', 'longitude')
+        levels = list(data_array.level.values) if has_level else [None]
+        for level_index, level in enumerate(levels):
+            file_name = name if level is None else f"{name}_{level}"
+            if per_time_step:
+                for time_index, t in enumerate(times):
+                    jobs.append((os.path.join(save_folder, f"{file_name}_{t.strftime('%Y%m%d%H')}.tif"), name, level_index, time_index))
+            else:
+                jobs.append((os.path.join(save_folder, f"{file_name}.tif"), name, level_index, None))
+
+    # [write the files in parallel]
+    # at most 2 * max_workers arrays are waiting in memory
+    with era5_metrics.phase('write'), concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for save_at, name, level_index, time_index in jobs:
+            data_array = data_arrays[name]
+            level_array = data_array[:, level_index] if 'level' in data_array.dims else data_array
+            if time_index is None:
+                bands = level_array.values
+                descriptions = time_descriptions
+            else:
+                bands = level_array[time_index].values[np.newaxis]
+                descriptions = [time_descriptions[time_index]]
+            if lon_order is not None:
+                bands = bands[:, :, lon_order]
+            pending.add(executor.submit(_write_geotiff, save_at, bands, transform_coefficients, descriptions, cog_options))
+            if len(pending) >= 2 * max_workers:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+        for future in concurrent.futures.as_completed(pending):
+            future.result()
+    era5_metrics.count('files_written', len(jobs))
+
+    return [save_at for save_at, _, _, _ in jobs]
+
+
 def era5_xarray_to_nparray(xarr: xarray.core.dataset.Dataset, variable: str, z: int | float, time: datetime.datetime) -> np.ndarray:
     """
     Save the specified variable, pressure level, time data in the xarray dataset to a numpy array.
@@ -195,9 +377,7 @@ def era5_xarray_to_nparray(xarr: xarray.core.dataset.Dataset, variable: str, z:
         raise ValueError(f"The input z({z}) should be in the xarray dataset, available levels: {available_levels}")
 
     # time should be in the xarr
-    available_times = list(map(lambda x: (pd.to_datetime(x).to_pydatetime().replace(tzinfo=datetime.timezone.utc)), list(xarr.time.values)))
-    if time not in available_times:
-        raise ValueError(f"The input time {time} should be in the xarray dataset, available times: {available_times}")
+    _time_should_be_in_xarr(xarr, time)
 
     # [get data array]
     variable = variable
@@ -208,17 +388,268 @@ def era5_xarray_to_nparray(xarr: xarray.core.dataset.Dataset, variable: str, z:
         level = int(z)
         array = xarr[variable].sel(level=level, time=time).values
 
-    # [get lat lon info]
-    lat_list = list(xarr.latitude.values)
-    lon_list = list(xarr.longitude.values)
-    delta_lat = abs(lat_list[1] - lat_list[0])
-    delta_lon = abs(lon_list[1] - lon_list[0])
-
     # [reorder the array]
     # longitude is from 0 to 360 originally, we need to convert it to -180 to 180
-    lon_gt_180 = [i for i, lon in enumerate(lon_list) if lon >= 180][0]
-    lon_list = lon_list[lon_gt_180:] + lon_list[:lon_gt_180]
-    lon_list = [lon - 360 if lon >= 180 else lon for lon in lon_list]
-    array = np.concatenate((array[:, lon_gt_180:], array[:, :lon_gt_180]), axis=1)
+    # no copy is made if the dataset is already shifted by `era5_xarray_shift_longitude`
+    lon_order = _lon_order(xarr.longitude.values)
+    if lon_order is not None:
+        array = array[:, lon_order]
 
     return array
+
+
+def era5_xarray_to_ndarray_block(xarr: xarray.core.dataset.Dataset, variable: str, times: list | None = None, levels: list | None = None) -> np.ndarray:
+    """
+    Get the data of the specified variable at many times and levels in the xarray dataset as one numpy array.
+
+    The times and levels are looked up with the indexes of the dataset. If they are evenly spaced in the dataset
+    (e.g. all the times, or a range of them), the array is a view of the loaded data instead of a copy. Longitude is
+    reordered from -180 to 180 for the whole block at once; call `era5_xarray_shift_longitude` once beforehand to
+    avoid reordering (and copying) on every call.
+
+    Args:
+        xarr: xarray.core.dataset.Dataset, the xarray dataset.
+        variable: str, the variable to get.
+        times: list of datetime.datetime or None, the times to get, if timezone is None, it is UTC. None for all the times.
+        levels: list of int or float or None, the levels to get. None for all the levels. Ignored if data has only one level.
+
+    Returns:
+        np.ndarray, the array with the dims (time, level, latitude, longitude), level has size 1 if data has only one level.
+    """
+    # [check input]
+    if not isinstance(xarr, xarray.core.dataset.Dataset):
+        raise ValueError("The input xarr should be an xarray dataset.")
+    if not isinstance(variable, str):
+        raise ValueError("The input variable should be a string.")
+    available_variables = list(xarr.data_vars)
+    if variable not in available_variables:
+        raise ValueError(f"The input variable({variable}) should be in the xarray dataset, available variables: {available_variables}")
+    data_array = xarr[variable]
+    has_level = 'level' in data_array.dims
+
+    # [look up the indices]
+    selection = {}
+    if times is not None:
+        times = [time.astimezone(datetime.timezone.utc).replace(tzinfo=None) if time.tzinfo is not None else time for time in times]
+        selection['time'] = _indexer(xarr.indexes['time'], np.array(times, dtype='datetime64[ns]'), 'time')
+    if levels is not None and has_level:
+        selection['level'] = _indexer(xarr.indexes['level'], np.asarray(levels), 'level')
+
+    # [get data array]
+    if has_level:
+        data_array = data_array.transpose('time', 'level', 'latitude', 'longitude')
+    else:
+        data_array = data_array.transpose('time', 'latitude', 'longitude')
+    array = data_array.isel(selection).values
+    if not has_level:
+        array = array[:, np.newaxis]
+
+    # [reorder the array]
+    lon_order = _lon_order(xarr.longitude.values)
+    if lon_order is not None:
+        array = array[..., lon_order]
+
+    return array
+
+
+def era5_xarray_shift_longitude(xarr: xarray.core.dataset.Dataset) -> xarray.core.dataset.Dataset:
+    """
+    Reorder the longitude of the xarray dataset from 0~360 to -180~180 once, so that the converter functions do not reorder it on every call.
+
+    Args:
+        xarr: xarray.core.dataset.Dataset, the xarray dataset.
+
+    Returns:
+        xarray.core.dataset.Dataset, the dataset with longitude from -180 to 180, the input itself if no reordering is needed.
+    """
+    if not isinstance(xarr, xarray.core.dataset.Dataset):
+        raise ValueError("The input xarr should be an xarray dataset.")
+
+    lon = xarr.longitude.values
+    lon_order = _lon_order(lon)
+    if lon_order is None:
+        return xarr
+    xarr = xarr.isel(longitude=lon_order)
+    return xarr.assign_coords(longitude=np.where(lon >= 180, lon - 360, lon)[lon_order])
+
+
+# [sub functions]
+def _geotiff_georeference(xarr: xarray.core.dataset.Dataset) -> tuple:
+    """
+    Calculate the longitude order from -180 to 180 and the geotiff transform of the dataset.
+
+    Returns:
+        lon_order (np.ndarray or None): The longitude indices from -180 to 180, None if no reordering is needed.
+        transform (Affine): The geotiff transform.
+    """
+    lat = xarr.latitude.values
+    lon = xarr.longitude.values
+    delta_lat = abs(lat[1] - lat[0])
+    delta_lon = abs(lon[1] - lon[0])
+
+    # longitude is from 0 to 360 originally, we need to convert it to -180 to 180
+    lon_order = _lon_order(lon)
+    if lon_order is not None:
+        lon = np.where(lon >= 180, lon - 360, lon)[lon_order]
+
+    # calculate georeference info
+    north = lat[0] + delta_lat / 2
+    west = lon[0] - delta_lon / 2
+    transform = affine.Affine(delta_lon, 0, west, 0, -delta_lat, north)
+    return lon_order, transform
+
+
+def _lon_order(lon: np.ndarray) -> np.ndarray | None:
+    """
+    Calculate the longitude indices which reorder the longitude from 0~360 to -180~180.
+
+    Returns:
+        np.ndarray or None: The longitude indices, None if no longitude is greater than or equal to 180.
+    """
+    lon_gt_180 = np.flatnonzero(lon >= 180)
+    if len(lon_gt_180) == 0:
+        return None
+    return np.concatenate((np.arange(lon_gt_180[0], len(lon)), np.arange(lon_gt_180[0])))
+
+
+def _indexer(index, labels: np.ndarray, name: str) -> slice | np.ndarray:
+    """
+    Look up the positions of the labels in the index, as a slice if they are evenly spaced so that the selection is a view.
+    """
+    positions = index.get_indexer(labels)
+    if (positions < 0).any():
+        raise ValueError(f"The input {name} {labels[positions < 0].tolist()} should be in the xarray dataset, available {name}: {index[0]} ~ {index[-1]}")
+    if len(positions) == 1:
+        return slice(positions[0], positions[0] + 1)
+    steps = np.diff(positions)
+    if steps[0] > 0 and (steps == steps[0]).all():
+        return slice(positions[0], positions[-1] + 1, steps[0])
+    return positions
+
+
+def _time_should_be_in_xarr(xarr: xarray.core.dataset.Dataset, time: datetime.datetime) -> None:
+    # look up the time in the index instead of converting every time in the dataset
+    if xarr.indexes['time'].get_indexer([np.datetime64(time.replace(tzinfo=None), 'ns')])[0] < 0:
+        time_index = xarr.indexes['time']
+        raise ValueError(f"The input time {time} should be in the xarray dataset, available times: {time_index[0]} ~ {time_index[-1]}")
+
+
+def _write_geotiff(save_at: str, bands: np.ndarray, transform: affine.Affine | tuple, descriptions: list | None = None, cog_options: dict | None = None) -> None:
+    """
+    Write the bands (band, latitude, longitude) to a geotiff file, runs in the worker processes of `era5_xarray_to_geotiffs`.
+
+    With cog_options, the file is a cloud optimized geotiff written by the GDAL COG driver, which builds the tiles and
+    the overviews when the file is closed.
+    """
+    if not isinstance(transform, affine.Affine):
+        transform = affine.Affine(*transform)
+    with rasterio.open(
+        save_at,
+        mode="w",
+        driver="GTiff" if cog_options is None else "COG",
+        height=bands.shape[1],
+        width=bands.shape[2],
+        count=bands.shape[0],
+        dtype=np.float32,
+        nodata=np.nan,
+        crs=rasterio.crs.CRS.from_epsg(4326),
+        transform=transform,
+        **(cog_options or {}),
+    ) as dst:
+        dst.write(bands.astype(np.float32, copy=False))
+        if descriptions is not None:
+            for band, description in enumerate(descriptions, start=1):
+                dst.set_band_description(band, description)
+    return None
+
+
+def _cog_options(cog: bool, compression: str | None, blocksize: int, overview_resampling: str) -> dict | None:
+    """
+    Check the cog options and build the creation options of the GDAL COG driver, None if cog is False.
+    """
+    if not isinstance(cog, bool):
+        raise ValueError("The input cog should be a boolean.")
+    if not cog:
+        return None
+    if compression not in (None, 'deflate', 'zstd', 'lzw'):
+        raise ValueError(f"The input compression should be None, 'deflate', 'zstd' or 'lzw', but got {compression}.")
+    if not isinstance(blocksize, int) or blocksize <= 0 or blocksize % 16 != 0:
+        raise ValueError(f"The input blocksize should be a positive multiple of 16, but got {blocksize}.")
+    if overview_resampling not in ('nearest', 'average', 'bilinear', 'cubic', 'mode'):
+        raise ValueError(f"The input overview_resampling should be 'nearest', 'average', 'bilinear', 'cubic' or 'mode', but got {overview_resampling}.")
+    options = {
+        'blocksize': blocksize,
+        'overviews': 'AUTO',  # halve the size until it fits in one tile
+        'overview_resampling': overview_resampling,
+        'bigtiff': 'IF_SAFER',
+    }
+    if compression is not None:
+        options.update({'compress': compression.upper(), 'predictor': 'YES'})  # the floating point predictor for float32
+    return options
+
+
+def _layout_chunk_size(dim: str, size: int, chunk_layout: str) -> int:
+    """
+    The chunk size of a dimension, 'map' keeps whole maps in a chunk, 'timeseries' keeps long time series of small areas in a chunk.
+    """
+    if chunk_layout == 'map':
+        return size if dim in ('latitude', 'longitude') else 1
+    if dim == 'time':
+        return min(size, 24 * 366)
+    if dim in ('latitude', 'longitude'):
+        return min(size, 32)
+    return 1
+
+
+def _packing_encoding(variable: xarray.DataArray, packing: str | None, max_error: float | None) -> dict:
+    """
+    The encoding packing the variable as int16 or float16, {} if the variable is stored unpacked.
+
+    The error bound includes the float32 rounding of the decoded values, so the decoded values are always within
+    max_error of the original values.
+    """
+    if packing is None or not np.issubdtype(variable.dtype, np.floating):
+        return {}
+    minimum, maximum = (float(value) for value in xarray.concat([variable.min(), variable.max()], dim='extreme').values)  # one pass over lazy data
+    if not np.isfinite(minimum) or not np.isfinite(maximum):
+        return {}  # all missing
+    largest = max(abs(minimum), abs(maximum))
+    float32_error = float(np.spacing(np.float32(largest)))
+
+    if packing == 'int16':
+        # -32767 ~ 32767 for the values, -32768 for the missing values
+        # the offset is rounded to float32 first and the scale covers both extremes around the rounded offset,
+        # otherwise the offset rounding of a narrow range can be larger than the scale and push the extremes out of int16
+        add_offset = np.float32((maximum + minimum) / 2)
+        half_range = max(maximum - float(add_offset), float(add_offset) - minimum)
+        scale_factor = np.float32(half_range / 32767) if half_range > 0 else np.float32(1)
+        if float(scale_factor) * 32767 < half_range:
+            scale_factor = np.nextafter(scale_factor, np.float32(np.inf))
+
+        # the extremes encoded like xarray does, in float32, should stay in int16
+        encoded = np.rint((np.array([minimum, maximum], dtype='float32') - add_offset) / scale_factor)
+        if np.abs(encoded).max() > 32767:
+            return {}
+
+        # half a step, the float32 rounding of the encoding division, and of the decoding product and sum
+        packed_error = float(scale_factor) * (0.5 + 32767 * 2.0 ** -23) + 2 * float32_error
+        if max_error is not None and packed_error > max_error:
+            return {}
+        return {'dtype': 'int16', 'scale_factor': scale_factor, 'add_offset': add_offset, '_FillValue': np.int16(-32768)}
+
+    # float16
+    if largest > float(np.finfo(np.float16).max):
+        return {}
+    if max_error is not None and float(np.spacing(np.float16(largest))) / 2 > max_error:
+        return {}
+    return {'dtype': 'float16'}
+
+
+def _zarr_compressor(codec: str | None, compression_level: int):
+    if codec is None:
+        return None
+    import numcodecs
+    if codec == 'zlib':
+        return numcodecs.Zlib(level=compression_level)
+    cname = 'zstd' if codec == 'zstd' else 'lz4'
+    return numcodecs.Blosc(cname=cname, clevel=compression_level, shuffle=numcodecs.Blosc.SHUFFLE)
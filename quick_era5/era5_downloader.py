@@ -1,22 +1,68 @@
+from __future__ import annotations
+
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
 import datetime
-import gcsfs
+import functools
+import hashlib
+import inspect
+import json
 import os
-import pickle
-import xarray
-gcs = gcsfs.GCSFileSystem(token='anon')
+import shutil
+import sqlite3
+import threading
+import time
+import warnings
+from . import era5_converter
+from . import era5_metrics
+from ._lazy_import import lazy_import
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    import msvcrt
+
+# the dependencies are imported on first use, so that `import quick_era5` is fast
+gcsfs = lazy_import('gcsfs')
+np = lazy_import('numpy')
+xarray = lazy_import('xarray')
+zarr = lazy_import('zarr')
+
+gcs = None  # the GCS file system, made by `_get_gcs` on first use, can be set to another fsspec file system
+_gcs_lock = threading.Lock()
 
 # config
 base_path = os.path.dirname(os.path.abspath(__file__))
-local_full_era5_zarr_at = os.path.join(base_path, 'asset', 'full_era5.pkl')
+local_era5_metadata_at = os.path.join(base_path, 'asset', 'era5_metadata.json')
 cache_era5_folder = os.path.join(base_path, 'cache', 'era5')
 
 era5_gcp_path = 'gs://gcp-public-data-arco-era5/ar/full_37-1h-0p25deg-chunk-1.zarr-v3'
 expire_days = 14
+cache_max_bytes = None  # if set, the least recently used cache files are removed when the cache is larger than this
+cache_format = 'netcdf'  # 'netcdf' or 'zarr', zarr cache files can be read partially if cache_chunk_layout is not None
+cache_chunk_layout = None  # None (one chunk per variable in zarr), 'map' or 'timeseries', see `era5_converter.era5_storage_encoding`
+cache_codec = None  # None, 'zlib', 'zstd' or 'blosc'
+cache_compression_level = 3
+cache_packing = None  # None, 'int16', 'float16' (zarr only) or a dict of variable -> packing, see `era5_converter.era5_storage_encoding`
+cache_packing_max_error = None  # None, the largest absolute error allowed by cache_packing, or a dict of variable -> max error
+
+# freshness check, check GCS for new era5 data at most once per `freshness_check_hours`
+freshness_check_hours = 24
+offline_mode = False  # if True, never check GCS for new era5 data
+background_freshness_check = False  # if True, check for new era5 data in a background thread without blocking the download
+
+# chunk cache, keep the raw zarr chunks fetched from era5_gcp_path so that overlapping requests only fetch the missing chunks
+chunk_cache_enabled = False
+chunk_cache_folder = os.path.join(base_path, 'cache', 'chunks')
+chunk_cache_max_bytes = 20 * 1024 ** 3  # 20 GB for each era5_gcp_path, least recently used chunks are removed when exceeded
 
 # constants
 utc = datetime.timezone.utc
 
 
+@era5_metrics.instrument
 def download_era5_data_from_gcs(
     variable_list: list,
     from_datetime: datetime.datetime,
@@ -26,6 +72,14 @@ def download_era5_data_from_gcs(
     latitude_range: tuple = (-90, 90),
     longitude_range: tuple = (0, 360),
     longitude_shift: bool = True,
+    longitude_wrap: bool = False,
+    max_workers: int = 1,
+    worker_memory_bytes: int = 256 * 1024 ** 2,
+    lazy: bool = False,
+    lazy_chunk_multiple: int = 1,
+    aggregation: dict | None = None,
+    target_resolution: float | None = None,
+    regrid_method: str = 'conservative',
 ) -> xarray.Dataset:
     """
     Download the era5 data from GCS and return the xarray dataset.
@@ -47,23 +101,931 @@ def download_era5_data_from_gcs(
             Longitude range to download. Default is (0, 360).
         longitude_shift (bool):
             If True, shift the longitude from -180~180 to 0-360. Default is True.
+        longitude_wrap (bool):
+            If True, longitude_range is read eastward from its first to its second value, so that a range crossing
+            0 (with longitude_shift) or 180 (without longitude_shift) can be downloaded in one call, e.g. (330, 30)
+            or (150, -150). Default is False, which downloads from the smaller to the larger value.
+        max_workers (int):
+            Number of threads fetching the data at the same time. Default is 1.
+        worker_memory_bytes (int):
+            Approximate bytes each thread fetches at a time, the data is split along time into parts of this size. Default is 256 MB.
+        lazy (bool):
+            If True, return a dask-backed dataset without downloading, each dask chunk is `lazy_chunk_multiple` chunks
+            (time steps) of the era5 zarr file. Only the computed chunks are fetched, through the chunk cache, so the
+            chunk cache fills as the chunks are computed. Default is False.
+        lazy_chunk_multiple (int):
+            Number of source chunks along time in each dask chunk when lazy. Default is 1.
+        aggregation (dict or None):
+            Aggregate the time steps while downloading, only the aggregated data is kept, cached and returned.
+            {'freq': 'daily', 'monthly' or hours (int), 'reducers': list of 'mean', 'min', 'max', 'sum'}, e.g.
+            {'freq': 'daily', 'reducers': ['mean', 'max']}. Each variable becomes '{variable}_{reducer}', and the
+            time is the start of each period (UTC), the first and last periods may be partial. Default is None.
+        target_resolution (float or None):
+            Average the data onto a coarser grid of this spacing in degrees while downloading, e.g. 0.5 or 1. It should
+            be a multiple of the era5 grid spacing (0.25) dividing 360. The centers of the coarse cells are the multiples
+            of it, e.g. 90, 89, ..., -90 and 0, 1, ..., 359 for 1, the polar cells are clipped to +-90, and the cells at
+            the edge of the ranges average only the part inside the ranges. Default is None (era5 grid).
+        regrid_method (str):
+            'conservative' weights the era5 cells by their area, 'block_mean' averages them equally. Default is 'conservative'.
 
     Returns:
         xarray.Dataset: The era5 dataset.
     """
-    # [update the local era5 if have new data]
-    update_if_have_new_era5()
+    # [check input]
+    request = _check_request(variable_list, from_datetime, to_datetime, time_interval, level_range, latitude_range, longitude_range, longitude_shift, longitude_wrap, aggregation, target_resolution, regrid_method)
+    _max_workers_should_be_positive_int(max_workers)
+    _worker_memory_bytes_should_be_positive_int(worker_memory_bytes)
+    _lazy_chunk_multiple_should_be_positive_int(lazy_chunk_multiple)
+    _lazy_should_not_be_with_aggregation_or_regrid(lazy, aggregation, target_resolution)
+
+    # [return the cache if exists]
+    # any cached file that covers the request can answer it, not only the one with the same name
+    xarr = _load_request_from_cache(request)
+    if xarr is not None:
+        return xarr.chunk({'time': lazy_chunk_multiple}) if lazy else xarr
+
+    # [select the data as dask arrays]
+    # nothing is downloaded here, the request cache is not written, the chunk cache is filled when computing
+    if lazy:
+        era5_metrics.count('cache_misses')
+        full_era5 = _open_full_era5_for_request(lazy=True)
+        xarr = _select_request(full_era5, request, time_step=request['time_interval'])
+        return xarr.chunk({'time': lazy_chunk_multiple})
+
+    # [download the data once]
+    # callers of the same request (threads or processes) wait for the one holding the lock, then read its cache
+    with _cache_lock(request['cache_name']):
+        xarr = _load_request_from_cache(request)
+        if xarr is not None:
+            return xarr
+
+        sliced_era5 = _select_request_from_gcs(request)
+        try:
+            sliced_era5 = _load_request(sliced_era5, request, max_workers, worker_memory_bytes)
+        except Exception as e:
+            raise ValueError(f"Error occurs when downloading the data, error message: {e}")
 
-    # [load the full era5 zarr file]
-    full_era5 = _load_full_era5()
-    valid_time_start = datetime.datetime.strptime(full_era5.valid_time_start, '%Y-%m-%d')
-    valid_time_stop = datetime.datetime.strptime(full_era5.valid_time_stop, '%Y-%m-%d')
-    valid_level_start = sorted(list(full_era5.level.to_series()))[0]
-    valid_level_stop = sorted(list(full_era5.level.to_series()))[-1]
+        # [save the data to the cache]
+        _save_request_to_cache(request, sliced_era5)
+
+    return sliced_era5
+
+
+def iter_era5_data_from_gcs(
+    variable_list: list,
+    from_datetime: datetime.datetime,
+    to_datetime: datetime.datetime,
+    time_interval: int = 1,
+    level_range: tuple | int = (1000, 0),
+    latitude_range: tuple = (-90, 90),
+    longitude_range: tuple = (0, 360),
+    longitude_shift: bool = True,
+    longitude_wrap: bool = False,
+    block_hours: int | str = 24,
+    max_workers: int = 1,
+    worker_memory_bytes: int = 256 * 1024 ** 2,
+):
+    """
+    Download the era5 data from GCS block by block along time and yield the xarray dataset of each block.
+
+    Only one block is held in memory at a time, so the memory does not grow with the time range. The blocks are
+    read from the cache if a cached file covers the whole request, otherwise from GCS, and are not saved to the cache.
+
+    Args:
+        variable_list, from_datetime, to_datetime, time_interval, level_range, latitude_range, longitude_range, longitude_shift, longitude_wrap:
+            Same as `download_era5_data_from_gcs`.
+        block_hours (int or str):
+            Hours of each block, or 'month' for calendar months. Default is 24.
+        max_workers, worker_memory_bytes:
+            Same as `download_era5_data_from_gcs`, used to fetch each block.
+
+    Yields:
+        xarray.Dataset: The era5 dataset of each block, in time order.
+    """
+    # [check input]
+    request = _check_request(variable_list, from_datetime, to_datetime, time_interval, level_range, latitude_range, longitude_range, longitude_shift, longitude_wrap)
+    _block_hours_should_be_positive_int_or_month(block_hours)
+    _max_workers_should_be_positive_int(max_workers)
+    _worker_memory_bytes_should_be_positive_int(worker_memory_bytes)
+
+    # [select the data lazily]
+    sliced_era5 = _load_request_from_cache(request)
+    if sliced_era5 is None:
+        sliced_era5 = _select_request_from_gcs(request)
+
+    # [load block by block]
+    for block_from_datetime, block_to_datetime in _split_time_blocks(request['from_datetime'], request['to_datetime'], time_interval, block_hours):
+        block = sliced_era5.sel(time=slice(block_from_datetime, block_to_datetime))
+        try:
+            block = _load_concurrently(block, max_workers, worker_memory_bytes)
+        except Exception as e:
+            raise ValueError(f"Error occurs when downloading the data, error message: {e}")
+        yield block
+
+
+def iter_era5_windows(
+    variable_list: list,
+    from_datetime: datetime.datetime,
+    to_datetime: datetime.datetime,
+    window_hours: int | str = 24,
+    prefetch: int = 2,
+    prefetch_workers: int = 1,
+    time_interval: int = 1,
+    level_range: tuple | int = (1000, 0),
+    latitude_range: tuple = (-90, 90),
+    longitude_range: tuple = (0, 360),
+    longitude_shift: bool = True,
+    longitude_wrap: bool = False,
+    max_workers: int = 1,
+    worker_memory_bytes: int = 256 * 1024 ** 2,
+    aggregation: dict | None = None,
+    target_resolution: float | None = None,
+    regrid_method: str = 'conservative',
+):
+    """
+    Yield the era5 dataset of each time window, e.g. day by day, while the next windows are downloaded into the cache
+    in the background, so that the download of the next windows overlaps with the work on the current one.
+
+    Each window is a `download_era5_data_from_gcs` call, so it's cached like one. While the caller works on window N,
+    windows N+1 ~ N+prefetch are downloaded into the cache by prefetch_workers threads; when the caller asks for a
+    window being prefetched, it waits for that download instead of starting another. At most prefetch_workers windows
+    are downloading in the background, and only the current window is held by the iterator.
+
+    Args:
+        variable_list, from_datetime, to_datetime, time_interval, level_range, latitude_range, longitude_range, longitude_shift, longitude_wrap:
+            Same as `download_era5_data_from_gcs`.
+        window_hours (int or str):
+            Hours of each window, or 'month' for calendar months. Default is 24.
+        prefetch (int):
+            Number of windows after the current one to download in the background, 0 for no prefetching. Default is 2.
+        prefetch_workers (int):
+            Number of windows downloaded in the background at the same time. Default is 1.
+        max_workers, worker_memory_bytes, aggregation, target_resolution, regrid_method:
+            Same as `download_era5_data_from_gcs`, used for each window.
+
+    Yields:
+        xarray.Dataset: The era5 dataset of each window, in time order.
+    """
+    # [check input]
+    # the whole range is checked once, so that a wrong input fails before any download
+    request = _check_request(variable_list, from_datetime, to_datetime, time_interval, level_range, latitude_range, longitude_range, longitude_shift, longitude_wrap, aggregation, target_resolution, regrid_method)
+    _block_hours_should_be_positive_int_or_month(window_hours)
+    _prefetch_should_be_non_negative_int(prefetch)
+    _prefetch_workers_should_be_positive_int(prefetch_workers)
+    _max_workers_should_be_positive_int(max_workers)
+    _worker_memory_bytes_should_be_positive_int(worker_memory_bytes)
+
+    windows = [
+        (window_from_datetime.replace(tzinfo=utc), window_to_datetime.replace(tzinfo=utc))
+        for window_from_datetime, window_to_datetime in _split_time_blocks(request['from_datetime'], request['to_datetime'], time_interval, window_hours)
+    ]
+    window_args = (time_interval, level_range, latitude_range, longitude_range, longitude_shift, longitude_wrap)
+
+    def download_window(i):
+        xarr = download_era5_data_from_gcs(
+            variable_list, *windows[i], *window_args,
+            max_workers=max_workers, worker_memory_bytes=worker_memory_bytes,
+            aggregation=aggregation, target_resolution=target_resolution, regrid_method=regrid_method,
+        )
+        # a cache hit is read from the file now and the file is closed, so that no thread touches the netcdf files
+        # outside `_netcdf_lock` while the prefetch threads write the next windows
+        with _netcdf_lock:
+            xarr.load()
+            xarr.close()
+        return xarr
+
+    def prefetch_window(i):
+        try:
+            window_request = _check_request(variable_list, *windows[i], *window_args, aggregation, target_resolution, regrid_method)
+            if _find_covering_cache_entry(window_request) is None:
+                download_window(i)  # only into the cache, the dataset is dropped
+        except Exception:
+            pass  # the error is raised when the caller asks for the window
+
+    # [yield window by window]
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch_workers, thread_name_prefix='quick_era5_prefetch')
+    prefetching = {}  # window index -> future
+    try:
+        for i in range(len(windows)):
+            for j in range(i + 1, min(i + 1 + prefetch, len(windows))):
+                if j not in prefetching:
+                    prefetching[j] = executor.submit(prefetch_window, j)
+            future = prefetching.pop(i, None)
+            if future is not None and not future.cancel():
+                future.result()  # wait for the running prefetch, then the window is read from the cache
+            yield download_window(i)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+@era5_metrics.instrument
+def download_era5_data_to_file(
+    variable_list: list,
+    from_datetime: datetime.datetime,
+    to_datetime: datetime.datetime,
+    save_at: str,
+    time_interval: int = 1,
+    level_range: tuple | int = (1000, 0),
+    latitude_range: tuple = (-90, 90),
+    longitude_range: tuple = (0, 360),
+    longitude_shift: bool = True,
+    longitude_wrap: bool = False,
+    block_hours: int | str = 24,
+    max_workers: int = 1,
+    worker_memory_bytes: int = 256 * 1024 ** 2,
+) -> None:
+    """
+    Download the era5 data from GCS block by block along time and append each block to a netcdf or zarr file.
+
+    Only one block is held in memory at a time, so requests larger than the memory can be downloaded.
+
+    Args:
+        variable_list, from_datetime, to_datetime, time_interval, level_range, latitude_range, longitude_range, longitude_shift, longitude_wrap:
+            Same as `download_era5_data_from_gcs`.
+        save_at (str):
+            The file path to save, a '.nc' file or a '.zarr' folder. An existing file is overwritten.
+        block_hours (int or str):
+            Hours of each block, or 'month' for calendar months. Default is 24.
+        max_workers, worker_memory_bytes:
+            Same as `download_era5_data_from_gcs`, used to fetch each block.
+
+    Returns:
+        None
+    """
+    _save_at_should_be_netcdf_or_zarr(save_at)
+
+    for i, block in enumerate(iter_era5_data_from_gcs(variable_list, from_datetime, to_datetime, time_interval, level_range, latitude_range, longitude_range, longitude_shift, longitude_wrap, block_hours, max_workers, worker_memory_bytes)):
+        if i == 0:
+            _write_first_block(block, save_at)
+        else:
+            _append_block(block, save_at)
+    return None
+
+
+@era5_metrics.instrument
+def sync_era5_archive(
+    archive_path: str,
+    to_datetime: datetime.datetime | None = None,
+    block_hours: int | str = 24,
+    max_workers: int = 1,
+    worker_memory_bytes: int = 256 * 1024 ** 2,
+) -> int:
+    """
+    Append the era5 data newer than the last time step of a local netcdf or zarr archive to the archive in place.
+
+    The variables, levels, latitudes, longitudes and time interval are taken from the archive, and only the time
+    steps after its last time step are downloaded, block by block along time. A netcdf archive without an unlimited
+    time dimension is rewritten once with an unlimited time dimension, later syncs append in place. A packed archive
+    (int16 or float16, see `era5_converter.era5_storage_encoding`) is refused, since the new time steps could be out
+    of the range and the error of its packing.
+
+    Args:
+        archive_path (str):
+            The '.nc' file or '.zarr' folder, e.g. written by `download_era5_data_to_file` or `era5_converter`.
+        to_datetime (datetime.datetime or None):
+            Last datetime (include) to append, must include timezone information. Default is None, which appends up to
+            the latest era5 data on GCS.
+        block_hours, max_workers, worker_memory_bytes:
+            Same as `iter_era5_data_from_gcs`.
+
+    Returns:
+        int: The number of appended time steps.
+    """
+    # [check input]
+    _save_at_should_be_netcdf_or_zarr(archive_path)
+    _archive_should_exist(archive_path)
+    if to_datetime is None:
+        update_if_have_new_era5(force=True)
+        to_datetime = get_local_era5_stop_time().replace(tzinfo=utc)
+
+    # [read the request of the archive]
+    archive = _open_archive(archive_path)
+    try:
+        _archive_should_not_be_packed(archive, archive_path)
+        request = _archive_request(archive)
+    finally:
+        archive.close()
+    from_datetime = request['last_datetime'] + datetime.timedelta(hours=request['time_interval'])
+    if from_datetime > to_datetime.astimezone(utc).replace(tzinfo=None):
+        return 0
+
+    # [append the new time steps]
+    if not archive_path.lower().endswith('.zarr'):
+        _make_netcdf_time_unlimited(archive_path)
+    n_appended = 0
+    for block in iter_era5_data_from_gcs(
+        request['variable_list'], from_datetime.replace(tzinfo=utc), to_datetime, request['time_interval'],
+        request['level_range'], request['latitude_range'], request['longitude_range'], request['longitude_shift'], request['longitude_wrap'],
+        block_hours, max_workers, worker_memory_bytes,
+    ):
+        _append_block(block, archive_path)
+        n_appended += block.sizes['time']
+    return n_appended
+
+
+@era5_metrics.instrument
+def download_many(
+    requests: list,
+    block_hours: int = 24,
+    max_workers: int = 1,
+    worker_memory_bytes: int = 256 * 1024 ** 2,
+) -> list:
+    """
+    Download the era5 data of many requests from GCS, the data shared by the requests is fetched only once.
+
+    The requests which are not in the cache are merged into one fetch plan: for each variable, the union of the
+    requested time steps is fetched once over the union of the requested levels, latitudes and longitudes, block by
+    block along time, and every block is split back into the requests. Each result is saved to the cache.
+
+    Args:
+        requests (list):
+            List of dict, each dict holds the arguments of `download_era5_data_from_gcs`. e.g.
+            [{'variable_list': ['temperature'], 'from_datetime': ..., 'to_datetime': ..., 'latitude_range': (0, 30)}, ...]
+            `lazy` and `lazy_chunk_multiple` are not supported, the results are always loaded.
+            The requests with an aggregation or a target_resolution are reduced after their blocks are fetched.
+        block_hours (int):
+            Hours of each fetched block, the memory used to fetch grows with it. Default is 24.
+        max_workers, worker_memory_bytes:
+            Same as `download_era5_data_from_gcs`, used to fetch each block.
+
+    Returns:
+        list: The era5 dataset of each request, in the same order as requests.
+    """
+    # [check input]
+    _requests_should_be_list_of_dict(requests)
+    _request_keys_should_be_supported_by_download_many(requests)
+    _block_hours_should_be_positive_int(block_hours)
+    _max_workers_should_be_positive_int(max_workers)
+    _worker_memory_bytes_should_be_positive_int(worker_memory_bytes)
+    checked_requests = [
+        _check_request(**{key: value for key, value in request.items() if key not in ('max_workers', 'worker_memory_bytes')})
+        for request in requests
+    ]
+
+    # [return the cache if exists]
+    results = [_load_request_from_cache(request) for request in checked_requests]
+    missing_cache_names = sorted({request['cache_name'] for request, xarr in zip(checked_requests, results) if xarr is None})
+    if len(missing_cache_names) == 0:
+        return results
+
+    # [download the rest once, grouped by the longitude convention]
+    # lock the stripes of the missing requests in order so that two batches never wait for each other,
+    # then look up the cache again for the requests written while waiting
+    with contextlib.ExitStack() as locks:
+        for stripe in sorted({_cache_lock_stripe(cache_name) for cache_name in missing_cache_names}):
+            locks.enter_context(_cache_stripe_lock(stripe))
+        results = [xarr if xarr is not None else _load_request_from_cache(request) for request, xarr in zip(checked_requests, results)]
+
+        for longitude_shift in (True, False):
+            group = [i for i, request in enumerate(checked_requests) if results[i] is None and request['longitude_shift'] == longitude_shift]
+            if len(group) == 0:
+                continue
+            group_results = _download_merged_requests([checked_requests[i] for i in group], block_hours, max_workers, worker_memory_bytes)
+            saved_cache_names = set()  # the same request may be in the batch more than once
+            for i, xarr in zip(group, group_results):
+                xarr = _load_request(xarr, checked_requests[i], max_workers, worker_memory_bytes)
+                if checked_requests[i]['cache_name'] not in saved_cache_names:
+                    _save_request_to_cache(checked_requests[i], xarr)
+                    saved_cache_names.add(checked_requests[i]['cache_name'])
+                results[i] = xarr
+
+    return results
+
+
+@era5_metrics.instrument
+def extract_era5_points(
+    variable_list: list,
+    from_datetime: datetime.datetime,
+    to_datetime: datetime.datetime,
+    latitudes,
+    longitudes,
+    station_ids=None,
+    method: str = 'nearest',
+    time_interval: int = 1,
+    level_range: tuple | int = (1000, 0),
+    longitude_shift: bool = True,
+    block_hours: int | str = 24,
+    max_workers: int = 1,
+    worker_memory_bytes: int = 256 * 1024 ** 2,
+    as_dataframe: bool = False,
+):
+    """
+    Extract the era5 time series at many points (e.g. weather stations) at once.
+
+    Only the bounding box of the points is downloaded, block by block along time, and all the points of a block are
+    looked up with one vectorized selection, so there is no Python loop over the points.
+
+    Args:
+        variable_list, from_datetime, to_datetime, time_interval, level_range, longitude_shift:
+            Same as `download_era5_data_from_gcs`.
+        latitudes (array-like):
+            Latitudes of the points, in -90~90.
+        longitudes (array-like):
+            Longitudes of the points, either in -180~180 or 0~360, converted to the convention of longitude_shift.
+        station_ids (array-like or None):
+            Ids of the points, used as the station coordinate. Default is None, which uses 0, 1, 2, ...
+        method (str):
+            'nearest' for the nearest grid point or 'linear' for bilinear interpolation (requires scipy). Default is 'nearest'.
+        block_hours, max_workers, worker_memory_bytes:
+            Same as `iter_era5_data_from_gcs`.
+        as_dataframe (bool):
+            If True, return a pandas.DataFrame indexed by time, (level,) station. Default is False.
+
+    Returns:
+        xarray.Dataset or pandas.DataFrame: The era5 data with the dims (time, (level,) station).
+    """
+    # [check input]
+    latitudes = np.asarray(latitudes, dtype=float).ravel()
+    longitudes = np.asarray(longitudes, dtype=float).ravel()
+    _points_should_have_same_length(latitudes, longitudes, station_ids)
+    _point_latitudes_should_in_valid_range(latitudes)
+    _method_should_be_nearest_or_linear(method)
+    if longitude_shift:
+        longitudes = longitudes % 360
+    else:
+        longitudes = ((longitudes + 180) % 360) - 180
+    if station_ids is None:
+        station_ids = np.arange(len(latitudes))
+
+    # [download the bounding box of the points]
+    # one more grid point on each side, so that the linear interpolation has its neighbours
+    era5_latitude = _load_era5_metadata()['coords']['latitude']
+    margin = abs(era5_latitude[1] - era5_latitude[0])
+    longitude_limit = (0, 360) if longitude_shift else (-180, 180)
+    latitude_range = (float(min(latitudes.max() + margin, 90)), float(max(latitudes.min() - margin, -90)))
+    longitude_range = (float(max(longitudes.min() - margin, longitude_limit[0])), float(min(longitudes.max() + margin, longitude_limit[1])))
+
+    # the points within one grid step west of 360 (180) are between the last and the first grid column, so the
+    # first column is downloaded too (across the seam unless the box already starts there) and put after the last
+    wrap_seam = bool((longitudes > longitude_limit[1] - margin).any())
+    longitude_wrap = wrap_seam and longitude_range[0] > longitude_limit[0]
+    if longitude_wrap:
+        longitude_range = (longitude_range[0], float(longitude_limit[0]))
+    point_latitudes = xarray.DataArray(latitudes, dims='station', coords={'station': station_ids})
+    point_longitudes = xarray.DataArray(longitudes, dims='station', coords={'station': station_ids})
+
+    # [look up the points block by block]
+    parts = []
+    for block in iter_era5_data_from_gcs(
+        variable_list, from_datetime, to_datetime, time_interval, level_range, latitude_range, longitude_range, longitude_shift, longitude_wrap,
+        block_hours=block_hours, max_workers=max_workers, worker_memory_bytes=worker_memory_bytes,
+    ):
+        if wrap_seam:
+            block = _append_longitude_seam(block)
+        if method == 'nearest':
+            part = block.sel(latitude=point_latitudes, longitude=point_longitudes, method='nearest')
+            parts.append(part.assign_coords(longitude=_convert_longitude(part.longitude, longitude_shift)) if wrap_seam else part)
+        else:
+            parts.append(block.interp(latitude=point_latitudes, longitude=point_longitudes, method='linear'))
+    points = xarray.concat(parts, dim='time', data_vars='minimal', coords='minimal', compat='override')
+
+    if as_dataframe:
+        return points.to_dataframe()
+    return points
+
+
+def _append_longitude_seam(block):
+    """
+    Make the longitudes of the block increase past 360 (180) with the first grid column, e.g. ..., 359.75, 360.
+
+    The block is either wrapped across the seam (e.g. 350, ..., 359.75, 0), whose columns after the seam are moved
+    up by 360, or covers the whole globe from its first column, which is appended at +360.
+    """
+    longitude = block.longitude.values
+    if longitude[0] > longitude[-1]:
+        return block.assign_coords(longitude=np.where(longitude < longitude[0], longitude + 360, longitude))
+    first_column = block.isel(longitude=[0])
+    return xarray.concat([block, first_column.assign_coords(longitude=first_column.longitude + 360)], dim='longitude')
+
+
+def show_era5_variables() -> list:
+    """
+    Show the variables in the era5 dataset.
+
+    Args:
+        None
+    Returns:
+        list, list of variables in the era5 dataset.
+    """
+    era5_metadata = _load_era5_metadata()
+    var_list = list(era5_metadata['variables'])
+    return var_list
+
+
+def download_era5_metadata(overwrite: bool = False) -> None:
+    """
+    Download the metadata of the full era5 zarr file from GCS and save it to the local directory.
+
+    The metadata holds the variables with their dims, shape, chunks and dtype, the coordinates except time,
+    and the valid time range, it is enough to check the input without opening the zarr file.
+
+    Args:
+        overwrite (bool): If True, download the metadata even if it exists. Default is False.
+    Returns:
+        None
+    """
+    # check if the file exists
+    if os.path.exists(local_era5_metadata_at) and not overwrite:
+        return
+
+    # download the metadata if not exists
+    full_era5 = xarray.open_zarr(_get_gcs().get_mapper(era5_gcp_path), chunks=None)
+    era5_metadata = {
+        'valid_time_start': full_era5.attrs['valid_time_start'],
+        'valid_time_stop': full_era5.attrs['valid_time_stop'],
+        'attrs': full_era5.attrs,
+        'dims': dict(full_era5.sizes),
+        'coords': {name: coord.values.tolist() for name, coord in full_era5.coords.items() if name != 'time'},
+        'level_range': [float(full_era5.level.min()), float(full_era5.level.max())],
+        'variables': {
+            name: {
+                'dims': list(variable.dims),
+                'shape': list(variable.shape),
+                'chunks': list(variable.encoding.get('chunks', variable.shape)),
+                'dtype': str(variable.dtype),
+            }
+            for name, variable in full_era5.data_vars.items()
+        },
+    }
+    os.makedirs(os.path.dirname(local_era5_metadata_at), exist_ok=True)
+    temp_path = f"{local_era5_metadata_at}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(era5_metadata, f, default=str)
+    os.replace(temp_path, local_era5_metadata_at)
+
+    # the pickled full era5 dataset of the older versions is not used anymore
+    old_full_era5_pickle_at = os.path.join(os.path.dirname(local_era5_metadata_at), 'full_era5.pkl')
+    if os.path.exists(old_full_era5_pickle_at):
+        os.remove(old_full_era5_pickle_at)
+    return
+
+
+def download_full_era5_zarr() -> None:
+    """
+    Deprecated, use `download_era5_metadata` instead, the full era5 zarr file is not pickled anymore.
+
+    Args:
+        None
+    Returns:
+        None
+    """
+    warnings.warn("download_full_era5_zarr is deprecated, use download_era5_metadata instead", DeprecationWarning, stacklevel=2)
+    download_era5_metadata()
+
+
+def remove_expired_cache() -> None:
+    """
+    Remove the cache files which are expired, except the ones being written by another caller.
+
+    Args:
+        None
+    Returns:
+        None
+    """
+    with _manifest_connection() as connection:
+        expired_rows = connection.execute('SELECT cache_name, path FROM cache_entries WHERE expire < ?', (time.time(),)).fetchall()
+        for cache_name, path in expired_rows:
+            with _cache_lock(cache_name, blocking=False) as locked:
+                if not locked:
+                    continue
+                _remove_cache_file(path)
+                connection.execute('DELETE FROM cache_entries WHERE cache_name = ?', (cache_name,))
+                era5_metrics.count('cache_evictions')
+
+
+def remove_cache_over_size() -> None:
+    """
+    Remove the least recently used cache files until the cache is not larger than `cache_max_bytes`, except the ones
+    being written by another caller.
+
+    Args:
+        None
+    Returns:
+        None
+    """
+    if cache_max_bytes is None:
+        return
+    with _manifest_connection() as connection:
+        total_bytes = connection.execute('SELECT COALESCE(SUM(size), 0) FROM cache_entries').fetchone()[0]
+        if total_bytes <= cache_max_bytes:
+            return
+        for cache_name, path, size in connection.execute('SELECT cache_name, path, size FROM cache_entries ORDER BY last_access').fetchall():
+            with _cache_lock(cache_name, blocking=False) as locked:
+                if not locked:
+                    continue  # being written by another caller
+                _remove_cache_file(path)
+                connection.execute('DELETE FROM cache_entries WHERE cache_name = ?', (cache_name,))
+                era5_metrics.count('cache_evictions')
+            total_bytes -= size
+            if total_bytes <= cache_max_bytes:
+                break
+
+
+def cache_stats() -> dict:
+    """
+    Show the statistics of the cache.
+
+    Args:
+        None
+    Returns:
+        dict, number of entries, total bytes, number of expired entries, and the oldest and newest access time of the cache.
+    """
+    with _manifest_connection() as connection:
+        entries, total_bytes, oldest_access, newest_access = connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(last_access), MAX(last_access) FROM cache_entries'
+        ).fetchone()
+        expired_entries = connection.execute('SELECT COUNT(*) FROM cache_entries WHERE expire < ?', (time.time(),)).fetchone()[0]
+    return {
+        'entries': entries,
+        'total_bytes': total_bytes,
+        'expired_entries': expired_entries,
+        'oldest_access': None if oldest_access is None else datetime.datetime.fromtimestamp(oldest_access),
+        'newest_access': None if newest_access is None else datetime.datetime.fromtimestamp(newest_access),
+        'expire_days': expire_days,
+        'max_bytes': cache_max_bytes,
+    }
+
+
+# [sub functions]
+_era5_metadata = None
+_full_era5 = {}  # (era5_gcp_path, chunk cache used, dask) -> lazily opened full era5 dataset
+
+
+def _load_era5_metadata() -> dict:
+    """
+    Load the era5 metadata, if not exists, download it from GCS then load it. The metadata is kept in memory after the first call.
+    """
+    global _era5_metadata
+    if _era5_metadata is None:
+        with era5_metrics.phase('metadata'):
+            download_era5_metadata()  # download the metadata if not exists
+            with open(local_era5_metadata_at) as f:
+                _era5_metadata = json.load(f)
+    return _era5_metadata
+
+
+def _load_full_era5(lazy: bool = False) -> xarray.Dataset:
+    """
+    Open the full era5 zarr file lazily, through the chunk cache if enabled. The dataset is kept in memory after the first call.
+
+    If lazy, the variables are dask arrays with the chunks of the zarr file, read through the chunk cache even if not enabled.
+    """
+    use_chunk_cache = chunk_cache_enabled or lazy
+    key = (era5_gcp_path, use_chunk_cache, lazy)
+    if key not in _full_era5:
+        with era5_metrics.phase('open_dataset'):
+            if use_chunk_cache:
+                store = _ChunkCacheStore(_get_gcs().get_mapper(era5_gcp_path), era5_gcp_path)
+            else:
+                store = _metered_store_class()(era5_gcp_path, fs=_get_gcs(), mode='r')
+            _full_era5[key] = xarray.open_zarr(store, chunks={} if lazy else None)
+    return _full_era5[key]
+
+
+def _get_gcs():
+    """
+    The GCS file system, made on first use and shared afterwards.
+    """
+    global gcs
+    if gcs is None:
+        with _gcs_lock:
+            if gcs is None:
+                gcs = gcsfs.GCSFileSystem(token='anon')
+    return gcs
+
+
+@functools.cache
+def _metered_store_class():
+    """
+    The class is made on first use, so that zarr is imported only when the era5 data is opened.
+    """
+    class _MeteredStore(zarr.storage.FSStore):
+        """
+        Read-only fsspec zarr store which counts the chunks and bytes fetched, the chunks of a selection are still fetched concurrently.
+        """
+        def __getitem__(self, key):
+            value = super().__getitem__(key)
+            if not _is_zarr_metadata_key(key):
+                era5_metrics.count('chunks_fetched')
+                era5_metrics.count('bytes_fetched', len(value))
+            return value
+
+        def getitems(self, keys, *, contexts):
+            values = super().getitems(keys, contexts=contexts)
+            chunk_values = [value for key, value in values.items() if not _is_zarr_metadata_key(key)]
+            if len(chunk_values) > 0:
+                era5_metrics.count('chunks_fetched', len(chunk_values))
+                era5_metrics.count('bytes_fetched', sum(len(value) for value in chunk_values))
+            return values
+
+    return _MeteredStore
+
+
+class _ChunkCacheStore(collections.abc.MutableMapping):
+    """
+    Read-only zarr store which keeps the chunks read from the source store in `chunk_cache_folder`.
+
+    Chunks are saved as `{chunk_cache_folder}/{hash of the source path}/{variable}/{chunk index}`, so the chunks of
+    another store (e.g. after `era5_gcp_path` is changed) are never served under the same keys. Metadata keys
+    (.zmetadata, .zattrs, ...) are always read from the source store because they change when the era5 dataset is
+    updated. When the size of the saved chunks of a source exceeds `chunk_cache_max_bytes`, its least recently used
+    chunks are removed.
+    """
+    _lock = threading.Lock()
+    _lrus = {}  # chunk folder -> OrderedDict, chunk key -> size in bytes, the least recently used chunk first
+    _lru_bytes = {}  # chunk folder -> bytes of its chunks
+
+    def __init__(self, source, source_path):
+        self.source = source
+        self.source_hash = hashlib.sha1(source_path.encode()).hexdigest()[:16]
+
+    def __getitem__(self, key):
+        if _is_zarr_metadata_key(key):
+            return self.source[key]
+
+        folder = self._folder()
+        path = os.path.join(folder, *key.split('/'))
+        with self._lock:
+            lru = self._get_lru(folder)
+            if key in lru:
+                lru.move_to_end(key)
+                try:
+                    with open(path, 'rb') as f:
+                        value = f.read()
+                    os.utime(path)  # keep the order after the index is rebuilt in another process
+                    era5_metrics.count('chunk_cache_hits')
+                    return value
+                except FileNotFoundError:  # removed by another process
+                    self._lru_bytes[folder] -= lru.pop(key)
+
+        era5_metrics.count('chunk_cache_misses')
+        value = self.source[key]  # raise KeyError if the chunk is missing, missing chunks are not cached
+        era5_metrics.count('chunks_fetched')
+        era5_metrics.count('bytes_fetched', len(value))
+        self._save_chunk(folder, key, path, value)
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._get_lru(self._folder()):
+                return True
+        return key in self.source
+
+    def __setitem__(self, key, value):
+        raise PermissionError("The era5 chunk cache store is read-only.")
+
+    def __delitem__(self, key):
+        raise PermissionError("The era5 chunk cache store is read-only.")
+
+    def __iter__(self):
+        return iter(self.source)
+
+    def __len__(self):
+        return len(self.source)
+
+    def _folder(self):
+        return os.path.join(chunk_cache_folder, self.source_hash)
+
+    def _save_chunk(self, folder, key, path, value):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(value)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            lru = self._get_lru(folder)
+            if key in lru:
+                self._lru_bytes[folder] -= lru.pop(key)
+            lru[key] = len(value)
+            self._lru_bytes[folder] += len(value)
+            while self._lru_bytes[folder] > chunk_cache_max_bytes and len(lru) > 1:
+                old_key, old_size = lru.popitem(last=False)
+                self._lru_bytes[folder] -= old_size
+                try:
+                    os.remove(os.path.join(folder, *old_key.split('/')))
+                except FileNotFoundError:
+                    pass
+
+    @classmethod
+    def _get_lru(cls, folder):
+        """
+        Build the LRU index from the files in the chunk folder the first time, ordered by last access.
+        """
+        if folder in cls._lrus:
+            return cls._lrus[folder]
+        chunk_files = []
+        for parent, _, files in os.walk(folder):
+            for file in files:
+                if file.endswith('.tmp'):
+                    continue
+                stat = os.stat(os.path.join(parent, file))
+                key = os.path.relpath(os.path.join(parent, file), folder).replace(os.sep, '/')
+                chunk_files.append((stat.st_mtime, key, stat.st_size))
+        cls._lrus[folder] = collections.OrderedDict((key, size) for _, key, size in sorted(chunk_files))
+        cls._lru_bytes[folder] = sum(cls._lrus[folder].values())
+        return cls._lrus[folder]
+
+
+def _is_zarr_metadata_key(key):
+    return key.split('/')[-1] in ('.zmetadata', '.zattrs', '.zarray', '.zgroup')
+
+
+def get_latest_era5_end_time():
+    era5_gcp_attr_path = f"{era5_gcp_path}/.zattrs"
+    era5_gcp_attr_content = json.loads(_get_gcs().cat(era5_gcp_attr_path))
+    latest_era5_end_time = datetime.datetime.strptime(era5_gcp_attr_content['valid_time_stop'], '%Y-%m-%d')
+    return latest_era5_end_time
+
+
+def get_local_era5_stop_time():
+    era5_metadata = _load_era5_metadata()
+    valid_time_stop = datetime.datetime.strptime(era5_metadata['valid_time_stop'], '%Y-%m-%d')
+    return valid_time_stop
+
+
+def update_if_have_new_era5(force: bool = False) -> None:
+    """
+    Update the local era5 metadata if GCS has new era5 data.
+
+    GCS is checked at most once per `freshness_check_hours`, never in `offline_mode`, and in a background thread
+    if `background_freshness_check` is True.
+
+    Args:
+        force (bool): If True, check GCS now and wait for the result, unless in `offline_mode`. Default is False.
+    Returns:
+        None
+    """
+    global _freshness_check_thread
+    if offline_mode:
+        return
+    if not force and not _freshness_check_due():
+        return
+    if background_freshness_check and not force:
+        with _freshness_check_lock:
+            if _freshness_check_thread is None or not _freshness_check_thread.is_alive():
+                _freshness_check_thread = threading.Thread(target=_update_if_have_new_era5_in_background, daemon=True)
+                _freshness_check_thread.start()
+        return
+    _update_if_have_new_era5()
+
+
+_freshness_check_lock = threading.Lock()
+_freshness_check_thread = None
+
+
+def _freshness_check_due():
+    try:
+        checked_at = os.path.getmtime(_freshness_checked_at_path())
+    except FileNotFoundError:
+        return True
+    return time.time() - checked_at >= freshness_check_hours * 3600
+
+
+def _freshness_checked_at_path():
+    return os.path.join(os.path.dirname(local_era5_metadata_at), 'era5_metadata_checked_at')
+
+
+def _update_if_have_new_era5():
+    global _era5_metadata
+    with era5_metrics.phase('freshness_check'):
+        latest_era5_end_time = get_latest_era5_end_time()
+        local_era5_stop_time = get_local_era5_stop_time()
+        if latest_era5_end_time > local_era5_stop_time:
+            download_era5_metadata(overwrite=True)  # replace the file atomically, other threads may be reading it
+            _era5_metadata = None  # reload the new metadata
+            _full_era5.clear()  # reopen the zarr file with the new metadata
+
+    # record the check time
+    checked_at_path = _freshness_checked_at_path()
+    with open(checked_at_path, 'a'):
+        pass
+    os.utime(checked_at_path)
+
+
+def _update_if_have_new_era5_in_background():
+    try:
+        _update_if_have_new_era5()
+    except Exception:
+        pass  # try again on the next download
+
+
+def _check_request(variable_list, from_datetime, to_datetime, time_interval=1, level_range=(1000, 0), latitude_range=(-90, 90), longitude_range=(0, 360), longitude_shift=True, longitude_wrap=False, aggregation=None, target_resolution=None, regrid_method='conservative'):
+    """
+    Check the input of a download and adjust it to the request used by the cache and the selection.
+
+    Returns:
+        dict: The request information, the datetimes are in UTC without timezone and the ranges are ordered.
+    """
+    # [load the era5 metadata]
+    era5_metadata = _load_era5_metadata()
+    valid_time_start = datetime.datetime.strptime(era5_metadata['valid_time_start'], '%Y-%m-%d')
+    valid_time_stop = datetime.datetime.strptime(era5_metadata['valid_time_stop'], '%Y-%m-%d')
+    valid_level_start, valid_level_stop = era5_metadata['level_range']
 
     # [check input]
     _variable_list_should_be_list(variable_list)
-    _all_var_should_be_in_era5_dataset_var_list(full_era5, variable_list)
+    _all_var_should_be_in_era5_dataset_var_list(era5_metadata['variables'], variable_list)
     _from_datetime_should_be_datetime(from_datetime)
     _from_datetime_should_have_timezone(from_datetime)
     from_datetime = (from_datetime.astimezone(utc)).replace(tzinfo=None)
@@ -73,6 +1035,10 @@ def download_era5_data_from_gcs(
     to_datetime = (to_datetime.astimezone(utc)).replace(tzinfo=None)
     _to_datetime_should_be_at_the_beginning_of_the_hour(to_datetime)
     _from_datetime_should_be_earlier_than_to_datetime(from_datetime, to_datetime)
+    if to_datetime > valid_time_stop and not offline_mode:
+        # the local metadata may be outdated, check GCS before rejecting the request
+        update_if_have_new_era5(force=True)
+        valid_time_stop = get_local_era5_stop_time()
     _from_datetime_should_be_in_valid_range(from_datetime, valid_time_start, valid_time_stop)
     _to_datetime_should_be_in_valid_range(to_datetime, valid_time_start, valid_time_stop)
     _level_range_should_be_tuple_or_int(level_range)
@@ -83,165 +1049,751 @@ def download_era5_data_from_gcs(
     latitude_range = _latitude_range_adjustment(latitude_range)  # 由小到大
     _longitude_range_should_be_tuple(longitude_range)
     _longitude_range_should_in_valid_range(longitude_range, longitude_shift)
-    longitude_range = _longitude_range_adjustment(longitude_range)  # 由小到大
+    if not longitude_wrap or longitude_range[0] <= longitude_range[1]:
+        longitude_range = _longitude_range_adjustment(longitude_range)  # 由小到大，跨越0度或180度的範圍則保留由西到東
     _time_interval_should_be_positive(time_interval)
+    _aggregation_should_be_none_or_valid_dict(aggregation)
+    aggregation = _aggregation_name(aggregation)  # e.g. 'daily-max-mean', '' for no aggregation
+    _target_resolution_should_be_none_or_multiple_of_era5_resolution(target_resolution, _era5_resolution())
+    _regrid_method_should_be_block_mean_or_conservative(regrid_method)
+    target_grid = _target_grid_name(target_resolution, regrid_method)  # e.g. '1-conservative', '' for the era5 grid
+
+    return {
+        'cache_name': _generate_cache_name(from_datetime, to_datetime, time_interval, variable_list, level_range, latitude_range, longitude_range, longitude_shift, aggregation, target_grid),
+        'from_datetime': from_datetime,
+        'to_datetime': to_datetime,
+        'time_interval': time_interval,
+        'variable_list': variable_list,
+        'level_range': level_range,
+        'latitude_range': latitude_range,
+        'longitude_range': longitude_range,
+        'longitude_shift': longitude_shift,
+        'aggregation': aggregation,
+        'target_grid': target_grid,
+    }
+
+
+def _load_request_from_cache(request):
+    """
+    Select the request lazily from the cached file which covers it, and remove the expired cache.
 
-    # [set the cache file information]
-    _, cache_expire_date_str = _calculate_cache_expire_date()
-    cache_name = _generate_cache_name(from_datetime, to_datetime, time_interval, variable_list, level_range, latitude_range, longitude_range, longitude_shift)
-
-    # [check if the cache exists]
-    if _cache_file_exist(cache_name):
-        xarr = _get_cache_file_xarr(cache_name)
-        _rename_cache_file(cache_name, cache_expire_date_str)
+    Returns:
+        xarray.Dataset or None: The selected data, None if no cached file covers the request.
+    """
+    with era5_metrics.phase('cache_lookup'):
+        covering_entry = _find_covering_cache_entry(request)
+        xarr = None
+        if covering_entry is not None:
+            xarr = _get_cache_file_xarr(covering_entry['cache_name'])
+            xarr = _select_cached_request(xarr, request, time_step=request['time_interval'] // covering_entry['time_interval'])
+            if covering_entry['path'].endswith('.zarr'):
+                # the chunks of a zarr folder removed later by the eviction would read as missing (all NaN),
+                # so only the selected chunks are read now
+                xarr = xarr.load()
+            _touch_cache_entry(covering_entry['cache_name'])
+    if xarr is not None:
+        era5_metrics.count('cache_hits')  # the misses are counted when the request goes to GCS
 
     # [remove expired cache]
     # while you run the code, if the cache is older than 14 days, remove the cache
-    remove_expired_cache()
+    with era5_metrics.phase('cache_eviction'):
+        remove_expired_cache()
+    return xarr
 
-    # [return the cache if exists]
-    if _cache_file_exist(cache_name):
-        return xarr
 
-    # [shift the longitude if needed]
-    if longitude_shift:
-        full_era5 = full_era5  # 下載的預設狀況就是有shift過的
-    else:
-        # print(full_era5.longitude)
-        full_era5 = full_era5.assign_coords(longitude=(((full_era5.longitude + 180) % 360) - 180)).sortby('longitude')
-
-    # [download the data]
+def _select_request_from_gcs(request):
+    """
+    Select the request lazily from the full era5 zarr file on GCS.
+    """
+    era5_metrics.count('cache_misses')
+    full_era5 = _open_full_era5_for_request()
     try:
-        sliced_era5 = (
-            full_era5
-            [variable_list]
-            .sel(
-                time=slice(from_datetime, to_datetime, time_interval),  # ???
-                level=slice(level_range[0], level_range[1]),
-                latitude=slice(latitude_range[0], latitude_range[1]),
-                longitude=slice(longitude_range[0], longitude_range[1])
-            )
-        )
-        sliced_era5 = sliced_era5.load()
+        return _select_request(full_era5, request, time_step=request['time_interval'])
     except Exception as e:
-        if "'level' is not a valid dimension or coordinate" in str(e):
-            sliced_era5 = (
-                full_era5
-                [variable_list]
-                .sel(
-                    time=slice(from_datetime, to_datetime, time_interval),
-                    latitude=slice(latitude_range[0], latitude_range[1]),
-                    longitude=slice(longitude_range[0], longitude_range[1])
-                )
-            )
-            sliced_era5 = sliced_era5.load()
-        else:
-            raise ValueError(f"Error occurs when downloading the data, error message: {e}")
+        raise ValueError(f"Error occurs when downloading the data, error message: {e}")
 
-    # [save the data to the cache]
-    cache_file_path = os.path.join(cache_era5_folder, f"{cache_name}_{cache_expire_date_str}.nc")
-    sliced_era5.to_netcdf(cache_file_path)
 
-    return sliced_era5
+def _open_full_era5_for_request(lazy=False):
+    """
+    Open the full era5 zarr file lazily for a request which is not in the cache, as dask arrays if lazy.
+    """
+    # [update the local era5 if have new data]
+    # only when the data is not in the cache, a cache hit never goes to GCS
+    update_if_have_new_era5()
 
+    # [open the full era5 zarr file]
+    # read the chunks through the chunk cache if enabled
+    # the longitude is shifted by `_select_request_space` after selecting, not on the full dataset
+    full_era5 = _load_full_era5(lazy)
+    return full_era5
 
-def show_era5_variables() -> list:
+
+def _save_request_to_cache(request, xarr):
     """
-    Show the variables in the era5 dataset.
+    Write the cache file to a temporary path and rename it, so that readers never see a half-written file.
+    Called while holding the lock of the request.
+    """
+    with era5_metrics.phase('cache_write'):
+        encoding = era5_converter.era5_storage_encoding(xarr, cache_format, cache_chunk_layout, cache_codec, cache_compression_level, cache_packing, cache_packing_max_error)
+        if cache_format == 'zarr':
+            cache_file_path = os.path.join(cache_era5_folder, f"{request['cache_name']}.zarr")
+            temp_path = f"{cache_file_path}.{os.getpid()}.tmp"
+            _remove_cache_file(temp_path)
+            xarr.to_zarr(temp_path, mode='w', encoding=encoding)
+            _remove_cache_file(cache_file_path)  # a folder can't be replaced by os.replace
+        else:
+            cache_file_path = os.path.join(cache_era5_folder, f"{request['cache_name']}.nc")
+            temp_path = f"{cache_file_path}.{os.getpid()}.tmp"
+            with _netcdf_lock:
+                xarr.to_netcdf(temp_path, encoding=encoding)
+        os.replace(temp_path, cache_file_path)
+        _register_cache_file(request['cache_name'], cache_file_path)
+    with era5_metrics.phase('cache_eviction'):
+        remove_cache_over_size()
+
+
+def _download_merged_requests(requests, block_hours, max_workers, worker_memory_bytes):
+    """
+    Download the requests (with the same longitude convention) by fetching each source chunk only once.
 
-    Args:
-        None
     Returns:
-        list, list of variables in the era5 dataset.
+        list: The loaded dataset of each request.
     """
-    # load the full era5 zarr file
-    try:
-        full_era5 = pickle.load(open(local_full_era5_zarr_at, 'rb'))
-    except FileNotFoundError:
-        download_full_era5_zarr()  # download the full era5 zarr file if not exists
-        full_era5 = pickle.load(open(local_full_era5_zarr_at, 'rb'))
+    era5_metrics.count('cache_misses', len(requests))
+    full_era5 = _open_full_era5_for_request()
+
+    # [build the fetch plan]
+    # the time steps of each request, and the union of the time steps and the space of all requests
+    request_times = [set(_request_time_steps(request)) for request in requests]
+    variable_times = {}
+    for request, times in zip(requests, request_times):
+        for variable in request['variable_list']:
+            variable_times.setdefault(variable, set()).update(times)
+    union_space = {
+        'level_range': (min(r['level_range'][0] for r in requests), max(r['level_range'][1] for r in requests)),
+        'latitude_range': (max(r['latitude_range'][0] for r in requests), min(r['latitude_range'][1] for r in requests)),
+        'longitude_range': (min(r['longitude_range'][0] for r in requests), max(r['longitude_range'][1] for r in requests)),
+        'longitude_shift': requests[0]['longitude_shift'],
+    }
+    if any(r['longitude_range'][0] > r['longitude_range'][1] for r in requests):
+        # a range crossing 0 or 180 is in the union only if the union is the whole circle
+        union_space['longitude_range'] = (0, 360) if union_space['longitude_shift'] else (-180, 180)
+    all_times = sorted(set().union(*request_times))
+
+    # [fetch block by block along time and split the blocks back into the requests]
+    request_parts = [[] for _ in requests]
+    block_start = 0
+    while block_start < len(all_times):
+        block_stop = block_start
+        while block_stop < len(all_times) and all_times[block_stop] - all_times[block_start] < datetime.timedelta(hours=block_hours):
+            block_stop += 1
+        block_times = set(all_times[block_start:block_stop])
+        block_start = block_stop
+
+        block = {}
+        for variable, times in variable_times.items():
+            times = sorted(times & block_times)
+            if len(times) == 0:
+                continue
+            variable_block = _select_request_space(full_era5[[variable]].sel(time=times), union_space)
+            try:
+                block[variable] = _load_concurrently(variable_block, max_workers, worker_memory_bytes)[variable]
+            except Exception as e:
+                raise ValueError(f"Error occurs when downloading the data, error message: {e}")
+
+        for request, times, parts in zip(requests, request_times, request_parts):
+            times = sorted(times & block_times)
+            if len(times) == 0:
+                continue
+            part = xarray.Dataset({variable: block[variable].sel(time=times) for variable in request['variable_list']}, attrs=full_era5.attrs)
+            parts.append(_select_request_space(part, request))
+
+    return [xarray.concat(parts, dim='time', data_vars='minimal', coords='minimal', compat='override') for parts in request_parts]
+
+
+def _request_time_steps(request):
+    interval = datetime.timedelta(hours=request['time_interval'])
+    n_steps = (request['to_datetime'] - request['from_datetime']) // interval + 1
+    return [request['from_datetime'] + i * interval for i in range(n_steps)]
+
+
+def _load_concurrently(xarr, max_workers, worker_memory_bytes):
+    """
+    Load the lazily selected dataset with max_workers threads, each thread loads a part of about worker_memory_bytes along time.
 
-    # show the variables
-    var_list = list(full_era5.data_vars)
-    return var_list
+    The source store has one time step per chunk, so the parts never share a chunk.
+    """
+    with era5_metrics.phase('fetch'):
+        if max_workers == 1 or 'time' not in xarr.dims:
+            return xarr.load()
 
+        bytes_per_time_step = sum(variable.nbytes // max(variable.sizes.get('time', 1), 1) for variable in xarr.data_vars.values())
+        time_steps_per_part = max(1, worker_memory_bytes // max(bytes_per_time_step, 1))
+        parts = [xarr.isel(time=slice(i, i + time_steps_per_part)) for i in range(0, xarr.sizes['time'], time_steps_per_part)]
+        if len(parts) == 1:
+            return xarr.load()
 
-def download_full_era5_zarr() -> None:
+        # the threads count the fetched chunks into the report of this call
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [era5_metrics.run_in_context(executor, part.load) for part in parts]
+            parts = [future.result() for future in futures]
+        return xarray.concat(parts, dim='time', data_vars='minimal', coords='minimal', compat='override')
+
+
+def _split_time_blocks(from_datetime, to_datetime, time_interval, block_hours):
     """
-    Download the full era5 zarr file from GCS and save it to the local directory.
+    Split the time steps from from_datetime to to_datetime (include) every time_interval hours into blocks.
 
     Args:
-        None
+        block_hours (int or str): Hours of each block, or 'month' for calendar months.
+
     Returns:
-        None
+        list of tuple: (first time step, last time step) of each block.
     """
-    # check if the file exists
-    if os.path.exists(local_full_era5_zarr_at):
-        return
+    interval = datetime.timedelta(hours=time_interval)
+    n_steps = (to_datetime - from_datetime) // interval + 1
+    if block_hours == 'month':
+        # index of the first time step of each month
+        block_starts = [0]
+        month_start = from_datetime.replace(day=1, hour=0)
+        while True:
+            month_start = (month_start + datetime.timedelta(days=32)).replace(day=1)
+            step = -((from_datetime - month_start) // interval)  # ceil
+            if step >= n_steps:
+                break
+            if step > block_starts[-1]:
+                block_starts.append(step)
+    else:
+        steps_per_block = max(1, block_hours // time_interval)
+        block_starts = list(range(0, n_steps, steps_per_block))
+    block_stops = block_starts[1:] + [n_steps]
+    return [(from_datetime + start * interval, from_datetime + (stop - 1) * interval) for start, stop in zip(block_starts, block_stops)]
 
-    # download full era5 zarr file if not exists
-    era5_path = era5_gcp_path
-    full_era5 = xarray.open_zarr(gcs.get_mapper(era5_path), chunks=None)
-    with open(local_full_era5_zarr_at, 'wb') as f:
-        pickle.dump(full_era5, f)
-    return
 
+def _load_request(xarr, request, max_workers, worker_memory_bytes):
+    """
+    Load the lazily selected request, coarsened and aggregated block by block along time if the request asks for it,
+    so that the memory grows with the reduced data instead of the era5 data.
+    """
+    if not request['aggregation'] and not request['target_grid']:
+        return _load_concurrently(xarr, max_workers, worker_memory_bytes)
 
-def remove_expired_cache() -> None:
-    for cache_file in os.listdir(cache_era5_folder):
-        expire_date_str = cache_file.split('_')[-1].split('.')[0]
-        try:
-            expire_date = datetime.datetime.strptime(expire_date_str, '%Y%m%d%H%M%S')
-            if expire_date < datetime.datetime.now():
-                os.remove(os.path.join(cache_era5_folder, cache_file))
-        except:
-            pass
+    bytes_per_time_step = sum(variable.nbytes // max(variable.sizes.get('time', 1), 1) for variable in xarr.data_vars.values())
+    steps_per_block = max(1, max_workers * worker_memory_bytes // max(bytes_per_time_step, 1))
+    blocks = (
+        _load_concurrently(xarr.isel(time=slice(start, start + steps_per_block)), max_workers, worker_memory_bytes)
+        for start in range(0, xarr.sizes['time'], steps_per_block)
+    )
+    if request['target_grid']:
+        blocks = (_regrid(block, request['target_grid'], request['longitude_shift']) for block in blocks)
+    if request['aggregation']:
+        return _aggregate(xarr, blocks, request['aggregation'])
+    return xarray.concat(list(blocks), dim='time', data_vars='minimal', coords='minimal', compat='override')
 
 
-# [sub functions]
-def _load_full_era5() -> xarray.Dataset:
+# [aggregation]
+_aggregation_reducers = ('mean', 'min', 'max', 'sum')
+_aggregation_cell_methods = {'mean': 'mean', 'min': 'minimum', 'max': 'maximum', 'sum': 'sum'}  # CF cell_methods
+
+
+def _aggregation_name(aggregation):
     """
-    Try load the full era5 zarr file, if not exists, download it from GCS then load it.
+    Normalize the aggregation dict to the string used by the request and the cache name, e.g. 'daily-max-mean', '24h-sum'.
     """
-    try:
-        full_era5 = pickle.load(open(local_full_era5_zarr_at, 'rb'))
-    except FileNotFoundError:
-        download_full_era5_zarr()  # download the full era5 zarr file if not exists
-        full_era5 = pickle.load(open(local_full_era5_zarr_at, 'rb'))
+    if aggregation is None:
+        return ''
+    freq = aggregation['freq']
+    freq_str = freq if isinstance(freq, str) else f"{freq}h"
+    return '-'.join([freq_str] + sorted(set(aggregation['reducers'])))
 
-    return full_era5
 
+def _aggregated_variable_names(request):
+    reducers = request['aggregation'].split('-')[1:]
+    return [f"{variable}_{reducer}" for variable in request['variable_list'] for reducer in reducers]
 
-def get_latest_era5_end_time():
-    era5_gcp_attr_path = 'gs://gcp-public-data-arco-era5/ar/full_37-1h-0p25deg-chunk-1.zarr-v3/.zattrs'
-    era5_gcp_attr_content = eval(gcs.cat(era5_gcp_attr_path))
-    latest_era5_end_time = datetime.datetime.strptime(era5_gcp_attr_content['valid_time_stop'], '%Y-%m-%d')
-    return latest_era5_end_time
 
+def _aggregation_periods(times, freq_str):
+    """
+    The start of the period of each time step, the periods are aligned to UTC days, months or multiples of hours since 1970.
+    """
+    times = times.astype('datetime64[h]')
+    if freq_str == 'daily':
+        periods = times.astype('datetime64[D]')
+    elif freq_str == 'monthly':
+        periods = times.astype('datetime64[M]')
+    else:
+        hours = int(freq_str[:-1])
+        periods = (times.astype('int64') // hours * hours).astype('datetime64[h]')
+    return periods.astype('datetime64[ns]')
 
-def get_local_era5_stop_time():
-    full_era5 = _load_full_era5()
-    valid_time_stop = datetime.datetime.strptime(full_era5.valid_time_stop, '%Y-%m-%d')
-    return valid_time_stop
 
+def _aggregate(xarr, blocks, aggregation):
+    """
+    Aggregate the loaded blocks of the lazily selected dataset into periods.
+
+    Only the running sum, minimum and maximum of each period are kept, so the memory is the size of the
+    aggregated data plus one block.
 
-def update_if_have_new_era5():
-    latest_era5_end_time = get_latest_era5_end_time()
-    local_era5_stop_time = get_local_era5_stop_time()
-    if latest_era5_end_time > local_era5_stop_time:
-        os.remove(local_full_era5_zarr_at)
-        download_full_era5_zarr()
+    Args:
+        xarr (xarray.Dataset): The lazily selected dataset, for its time steps and attributes.
+        blocks (iterable): The loaded blocks of xarr along time, in time order, maybe on a coarser grid.
+        aggregation (str): The aggregation of the request, e.g. 'daily-max-mean'.
+    """
+    freq_str, *reducers = aggregation.split('-')
+    period_of_step = _aggregation_periods(xarr.time.values, freq_str)
+    periods = np.unique(period_of_step)
+    period_index = np.searchsorted(periods, period_of_step)
+    counts = np.bincount(period_index, minlength=len(periods))
+
+    # [accumulate block by block]
+    # accumulators[variable][reducer] has the periods as the first axis, the mean is accumulated as a float64 sum
+    accumulators = {}
+    start = 0
+    for block in blocks:
+        block_period_index = period_index[start:start + block.sizes['time']]
+        start += block.sizes['time']
+        for name, variable in block.data_vars.items():
+            values = variable.transpose('time', ...).values
+            if name not in accumulators:
+                accumulators[name] = {reducer: _empty_accumulator(reducer, (len(periods),) + values.shape[1:], values.dtype) for reducer in reducers}
+            for i in np.unique(block_period_index):
+                period_values = values[block_period_index == i]
+                for reducer, accumulator in accumulators[name].items():
+                    if reducer in ('mean', 'sum'):
+                        accumulator[i] += period_values.sum(axis=0, dtype='float64')
+                    elif reducer == 'min':
+                        np.minimum(accumulator[i], period_values.min(axis=0), out=accumulator[i])
+                    else:
+                        np.maximum(accumulator[i], period_values.max(axis=0), out=accumulator[i])
+
+    # [build the aggregated dataset]
+    data_vars = {}
+    for name, variable in block.data_vars.items():
+        dims = ('time',) + tuple(dim for dim in variable.dims if dim != 'time')
+        for reducer, accumulator in accumulators[name].items():
+            if reducer == 'mean':
+                accumulator = accumulator / counts.reshape((-1,) + (1,) * (accumulator.ndim - 1))
+            attrs = dict(variable.attrs, cell_methods=f"time: {_aggregation_cell_methods[reducer]}")
+            data_vars[f"{name}_{reducer}"] = (dims, accumulator.astype(variable.dtype), attrs)
+    coords = {name: coord for name, coord in block.coords.items() if 'time' not in coord.dims}
+    coords['time'] = periods
+    return xarray.Dataset(data_vars, coords=coords, attrs=dict(xarr.attrs, aggregation=aggregation))
+
+
+def _empty_accumulator(reducer, shape, dtype):
+    if reducer in ('mean', 'sum'):
+        return np.zeros(shape, dtype='float64')
+    return np.full(shape, np.inf if reducer == 'min' else -np.inf, dtype=np.result_type(dtype, 'float32'))
+
+
+# [regrid]
+def _era5_resolution():
+    era5_latitude = _load_era5_metadata()['coords']['latitude']
+    return abs(era5_latitude[1] - era5_latitude[0])
+
+
+def _target_grid_name(target_resolution, regrid_method):
+    """
+    The target grid used by the request and the cache name, e.g. '1-conservative', '0.5-blockmean'.
+    """
+    if target_resolution is None:
+        return ''
+    return f"{target_resolution:g}-{regrid_method.replace('_', '')}"  # '_' separates the parts of the cache name
+
+
+def _regrid(xarr, target_grid, longitude_shift):
+    """
+    Average the loaded dataset onto the coarse grid, with the area of the era5 cells as weights if conservative.
+
+    The centers of the coarse cells are the multiples of the target resolution, e.g. 90, 89, ..., -90 and 0, 1, ..., 359
+    for 1 degree, like the era5 grid itself, so the coarse grid is the same for every request and the polar cells are
+    clipped to +-90. An era5 cell on the edge of two coarse cells is split between them, and a coarse cell at the edge
+    of the ranges, or with missing values, averages only the era5 cells inside the ranges with values.
+    """
+    resolution_str, method = target_grid.split('-')
+    era5_resolution = _era5_resolution()
+    factor = int(round(float(resolution_str) / era5_resolution))
+    target_resolution = factor * era5_resolution
+
+    # [coarse cells of each latitude and longitude]
+    # the longitudes may cross 0 or 180, the coarse cells are ordered as they first appear along the longitudes
+    latitude = xarr.latitude.values
+    longitude = xarr.longitude.values
+    latitude_limit = int(round(90 / era5_resolution))
+    if method == 'conservative':
+        half_cell = np.radians(era5_resolution / 2)
+        latitude_overlap = lambda start, stop: np.sin(stop * half_cell) - np.sin(start * half_cell)
+    else:
+        latitude_overlap = lambda start, stop: (stop - start).astype('float64')
+    latitude_matrix, latitude_cells = _cell_matrix(np.rint(latitude / era5_resolution).astype('int64'), factor, latitude_overlap, latitude_limit)
+    longitude_matrix, longitude_cells = _cell_matrix(np.rint((longitude % 360) / era5_resolution).astype('int64'), factor, lambda start, stop: (stop - start).astype('float64'), cells_around=int(round(360 / target_resolution)))
+
+    # [weighted mean of each cell]
+    # sum(weight * value) / sum(weight) over the cells with values, as two matrix products on the last two axes
+    data_vars = {}
+    for name, variable in xarr.data_vars.items():
+        other_dims = [dim for dim in variable.dims if dim not in ('latitude', 'longitude')]
+        values = variable.transpose(*other_dims, 'latitude', 'longitude').values
+        has_value = np.isfinite(values)
+        weighted_sum = latitude_matrix @ np.where(has_value, values, 0) @ longitude_matrix.T
+        weight_sum = latitude_matrix @ has_value.astype('float64') @ longitude_matrix.T
+        with np.errstate(invalid='ignore', divide='ignore'):
+            regridded = (weighted_sum / weight_sum).astype(variable.dtype)
+        data_vars[name] = ((*other_dims, 'latitude', 'longitude'), regridded, variable.attrs)
+
+    coords = {name: coord for name, coord in xarr.coords.items() if name not in ('latitude', 'longitude') and 'latitude' not in coord.dims and 'longitude' not in coord.dims}
+    coords['latitude'] = latitude_cells * target_resolution
+    coords['longitude'] = _convert_longitude(longitude_cells * target_resolution, longitude_shift)
+    return xarray.Dataset(data_vars, coords=coords, attrs=dict(xarr.attrs, target_grid=target_grid))
+
+
+def _cell_matrix(positions, factor, overlap, limit=None, cells_around=None):
+    """
+    The matrix summing the weighted values of each coarse cell.
+
+    In units of half an era5 cell, the era5 cell at position i (the coordinate / era5 resolution) spans [2i-1, 2i+1],
+    clipped to +-limit, and the coarse cell k spans [2k*factor-factor, 2k*factor+factor], so an era5 cell is in one
+    coarse cell or split between two.
+
+    Args:
+        positions (np.ndarray): The int positions of the era5 cells, in order.
+        factor (int): The era5 cells across each coarse cell.
+        overlap (callable): (start, stop) in half era5 cells -> weight of that part of an era5 cell.
+        limit (int or None): The position of the edge of the grid, e.g. 90 degrees for latitude, None for no edge.
+        cells_around (int or None): The coarse cells around the globe for longitude, whose cells wrap at 360. Default is None.
+    Returns:
+        np.ndarray: (number of coarse cells, number of positions) weights.
+        np.ndarray: The coarse cell of each row, in the order they first appear along the positions.
+    """
+    start, stop = 2 * positions - 1, 2 * positions + 1
+    if limit is not None:
+        start, stop = np.maximum(start, -2 * limit), np.minimum(stop, 2 * limit)
+    first_cell = (start + factor) // (2 * factor)
+    split = np.minimum(stop, 2 * factor * first_cell + factor)
+
+    # the part in the first cell and the part in the next cell (empty unless split) of each era5 cell
+    cells = np.stack([first_cell, first_cell + 1], axis=1).ravel()
+    columns = np.repeat(np.arange(len(positions)), 2)
+    weights = np.stack([overlap(start, split), overlap(split, stop)], axis=1).ravel()
+    used = np.stack([split > start, stop > split], axis=1).ravel()
+    cells, columns, weights = cells[used], columns[used], weights[used]
+    if cells_around is not None:
+        cells = cells % cells_around
+
+    unique_cells, first_index, rows = np.unique(cells, return_index=True, return_inverse=True)
+    order = np.argsort(first_index)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    matrix = np.zeros((len(unique_cells), len(positions)))
+    np.add.at(matrix, (rank[rows], columns), weights)
+    return matrix, unique_cells[order]
+
+
+def _write_first_block(xarr, save_at):
+    # the encoding of the era5 zarr store (global chunks of all levels) is dropped, so that each appended block
+    # writes chunks of the block's size, one per time step and level like `era5_converter.era5_xarray_to_zarr`
+    xarr = xarr.drop_encoding()
+    with era5_metrics.phase('write'):
+        if save_at.lower().endswith('.zarr'):
+            xarr.to_zarr(save_at, mode='w', encoding=era5_converter.era5_storage_encoding(xarr, 'zarr', 'map', 'zstd', 3))
+        else:
+            xarr.to_netcdf(save_at, unlimited_dims=['time'])  # so that the next blocks can be appended
+
+
+def _append_block(xarr, save_at):
+    """
+    Append the block to the end of the time dimension of the netcdf or zarr file written by `_write_first_block`.
+    """
+    with era5_metrics.phase('write'):
+        if save_at.lower().endswith('.zarr'):
+            xarr.to_zarr(save_at, append_dim='time')
+            return
+
+        import netCDF4
+        with netCDF4.Dataset(save_at, mode='a') as nc:
+            nc_time = nc.variables['time']
+            start = len(nc_time)
+            stop = start + xarr.sizes['time']
+            nc_time[start:stop] = netCDF4.date2num(
+                list(xarr.indexes['time'].to_pydatetime()),
+                units=nc_time.units,
+                calendar=getattr(nc_time, 'calendar', 'standard'),
+            )
+            for name, variable in xarr.data_vars.items():
+                if 'time' not in variable.dims:
+                    continue
+                nc_variable = nc.variables[name]
+                index = tuple(slice(start, stop) if dim == 'time' else slice(None) for dim in nc_variable.dimensions)
+                nc_variable[index] = variable.transpose(*nc_variable.dimensions).values
+
+
+def _open_archive(archive_path):
+    if archive_path.lower().endswith('.zarr'):
+        return xarray.open_zarr(archive_path, chunks=None)
+    return xarray.open_dataset(archive_path, engine='netcdf4')
+
+
+def _archive_request(archive):
+    """
+    Infer the request which the archive was downloaded with, and its last time step.
+    """
+    times = archive.indexes['time']
+    time_interval = 1
+    if len(times) > 1:
+        time_interval = int((times[-1] - times[-2]) / datetime.timedelta(hours=1))
+
+    level_range = tuple(_load_era5_metadata()['level_range'])
+    if 'level' in archive.dims:
+        level_range = (archive.level.values.min().item(), archive.level.values.max().item())
+
+    latitude = archive.latitude.values
+    longitude = archive.longitude.values
+    longitude_shift = not (longitude < 0).any()  # 0~180 is the same in both conventions
+    longitude_wrap = len(longitude) > 1 and (np.diff(longitude) < 0).any()
+    if longitude_wrap:
+        longitude_range = (longitude[0].item(), longitude[-1].item())
+    else:
+        longitude_range = (longitude.min().item(), longitude.max().item())
+
+    return {
+        'variable_list': list(archive.data_vars),
+        'last_datetime': times[-1].to_pydatetime(),
+        'time_interval': time_interval,
+        'level_range': level_range,
+        'latitude_range': (latitude.max().item(), latitude.min().item()),
+        'longitude_range': longitude_range,
+        'longitude_shift': longitude_shift,
+        'longitude_wrap': longitude_wrap,
+    }
 
 
-def _generate_cache_name(from_datetime, to_datetime, time_interval, variable_list, level_range, latitude_range, longitude_range, longitude_shift):
+def _make_netcdf_time_unlimited(path):
+    """
+    Rewrite the netcdf file with an unlimited time dimension if it is not, so that time steps can be appended.
+    """
+    import netCDF4
+    with netCDF4.Dataset(path) as nc:
+        if nc.dimensions['time'].isunlimited():
+            return
+    with xarray.open_dataset(path, engine='netcdf4') as xarr:
+        xarr = xarr.load()
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    xarr.to_netcdf(temp_path, unlimited_dims=['time'])
+    os.replace(temp_path, path)
+
+
+def _generate_cache_name(from_datetime, to_datetime, time_interval, variable_list, level_range, latitude_range, longitude_range, longitude_shift, aggregation='', target_grid=''):
     from_datetime_str = from_datetime.strftime('%Y%m%d%H')  # '2023010112'
     to_datetime_str = to_datetime.strftime('%Y%m%d%H')  # '2023010212'
     variable_list = sorted(variable_list)  # ['geopotential', 'temperature', ...]
-    variable_list_str = '_'.join(variable_list)  # 'geopotential_temperature_...'
+    variable_list_str = '-'.join(variable_list)  # 'geopotential-temperature-...', variable names already contain '_'
     cache_name = f'{from_datetime_str}_{to_datetime_str}_{time_interval}_{variable_list_str}_{level_range[0]}_{level_range[1]}_{latitude_range[0]}_{latitude_range[1]}_{longitude_range[0]}_{longitude_range[1]}_{longitude_shift}'
+    if aggregation:
+        cache_name += f'_agg-{aggregation}'  # '..._True_agg-daily-max-mean'
+    if target_grid:
+        cache_name += f'_grid-{target_grid}'  # '..._True_grid-1-conservative'
     return cache_name
 
 
+def _cache_entry_from_name(cache_name):
+    """
+    Parse a cache name (with or without the expire date and extension) back into the request it was generated from.
+
+    Returns:
+        dict or None: The request information, None if the name is not a cache name.
+    """
+    parts = cache_name.split('.nc')[0].split('.zarr')[0].split('_')
+    aggregation = ''
+    target_grid = ''
+    if parts[-1].startswith('grid-'):
+        target_grid = parts.pop()[len('grid-'):]
+    if parts[-1].startswith('agg-'):
+        aggregation = parts.pop()[len('agg-'):]
+    if len(parts) > 3 + 1 + 7 and parts[-1] not in ('True', 'False'):
+        parts = parts[:-1]  # drop the expire date
+    if len(parts) < 3 + 1 + 7:
+        return None
+    try:
+        return {
+            'from_datetime': datetime.datetime.strptime(parts[0], '%Y%m%d%H'),
+            'to_datetime': datetime.datetime.strptime(parts[1], '%Y%m%d%H'),
+            'time_interval': int(parts[2]),
+            'variable_list': '_'.join(parts[3:-7]).split('-'),
+            'level_range': (float(parts[-7]), float(parts[-6])),
+            'latitude_range': (float(parts[-5]), float(parts[-4])),
+            'longitude_range': (float(parts[-3]), float(parts[-2])),
+            'longitude_shift': parts[-1] == 'True',
+            'aggregation': aggregation,
+            'target_grid': target_grid,
+        }
+    except ValueError:
+        return None
+
+
+def _cache_entry_covers_request(entry, request):
+    """
+    Check whether the data of a cache entry contains all the data of the request.
+    """
+    if entry['longitude_shift'] != request['longitude_shift']:
+        return False
+    if not set(request['variable_list']).issubset(entry['variable_list']):
+        return False
+
+    # the aggregated periods depend on the time range, only the same time range can be reused
+    if entry['aggregation'] != request['aggregation']:
+        return False
+    if request['aggregation'] and (entry['from_datetime'], entry['to_datetime'], entry['time_interval']) != (request['from_datetime'], request['to_datetime'], request['time_interval']):
+        return False
+
+    # the coarse cells at the edge of the ranges depend on the ranges, only the same ranges can be reused
+    if entry['target_grid'] != request['target_grid']:
+        return False
+    if request['target_grid'] and (entry['latitude_range'], entry['longitude_range']) != (request['latitude_range'], request['longitude_range']):
+        return False
+
+    # every requested time step should also be a cached time step
+    if request['from_datetime'] < entry['from_datetime'] or request['to_datetime'] > entry['to_datetime']:
+        return False
+    offset_hours = (request['from_datetime'] - entry['from_datetime']).total_seconds() / 3600
+    if offset_hours % entry['time_interval'] != 0 or request['time_interval'] % entry['time_interval'] != 0:
+        return False
+
+    # level range is (min, max), latitude range is (max, min)
+    if request['level_range'][0] < entry['level_range'][0] or request['level_range'][1] > entry['level_range'][1]:
+        return False
+    if request['latitude_range'][0] > entry['latitude_range'][0] or request['latitude_range'][1] < entry['latitude_range'][1]:
+        return False
+
+    # longitude ranges may cross 0 or 180, compare them as arcs going eastward
+    entry_length = _longitude_range_length(entry['longitude_range'])
+    if entry_length >= 360:
+        return True
+    offset = (request['longitude_range'][0] - entry['longitude_range'][0]) % 360
+    return offset + _longitude_range_length(request['longitude_range']) <= entry_length
+
+
+def _find_covering_cache_entry(request):
+    """
+    Find the cache entry which covers the request, the smallest file is preferred when several entries cover it.
+
+    Returns:
+        dict or None: The covering entry with its cache name, None if no entry covers the request.
+    """
+    with _manifest_connection() as connection:
+        rows = connection.execute(
+            f'SELECT {", ".join(_manifest_entry_columns)} FROM cache_entries '
+            'WHERE longitude_shift = ? AND from_datetime <= ? AND to_datetime >= ? '
+            'AND level_lo <= ? AND level_hi >= ? AND lat_hi >= ? AND lat_lo <= ? '
+            'AND aggregation = ? AND target_grid = ? AND expire >= ? ORDER BY size',
+            (
+                request['longitude_shift'],
+                request['from_datetime'].strftime('%Y%m%d%H'), request['to_datetime'].strftime('%Y%m%d%H'),
+                request['level_range'][0], request['level_range'][1],
+                request['latitude_range'][0], request['latitude_range'][1],
+                request['aggregation'], request['target_grid'],
+                time.time(),
+            ),
+        ).fetchall()
+        for row in rows:
+            entry = _cache_entry_from_row(row)
+            if not _cache_entry_covers_request(entry, request):
+                continue
+            if not os.path.exists(entry['path']):  # removed outside of the package
+                connection.execute('DELETE FROM cache_entries WHERE cache_name = ?', (entry['cache_name'],))
+                continue
+            return entry
+    return None
+
+
+def _select_request(xarr, request, time_step):
+    """
+    Select the variables, time steps, levels, latitudes and longitudes of the request from the dataset.
+
+    Args:
+        xarr (xarray.Dataset): The full era5 dataset or a cached dataset covering the request.
+        request (dict): The request information, see `_check_request`.
+        time_step (int): Step between selected time steps of xarr.
+    """
+    xarr = xarr[request['variable_list']]
+    xarr = xarr.sel(time=slice(request['from_datetime'], request['to_datetime'], time_step))
+    return _select_request_space(xarr, request)
+
+
+def _select_cached_request(xarr, request, time_step):
+    """
+    Select the request from a cached dataset covering it, which may be aggregated or on a coarser grid.
+    """
+    if not request['aggregation'] and not request['target_grid']:
+        return _select_request(xarr, request, time_step)
+
+    if request['aggregation']:
+        xarr = xarr[_aggregated_variable_names(request)]  # a cached aggregation covering the request has the same periods
+    else:
+        xarr = xarr[request['variable_list']].sel(time=slice(request['from_datetime'], request['to_datetime'], time_step))
+    if not request['target_grid']:
+        return _select_request_space(xarr, request)
+    if 'level' in xarr.dims:  # a cached coarse grid covering the request has the same latitudes and longitudes
+        xarr = xarr.sel(level=slice(request['level_range'][0], request['level_range'][1]))
+    return xarr
+
+
+def _select_request_space(xarr, request):
+    """
+    Select the levels, latitudes and longitudes of the request from the dataset.
+
+    The longitudes are selected by position and converted to the convention of the request, so the source dataset
+    (0~360) is never reordered as a whole. A range crossing 0 or 180 is read with one orthogonal selection.
+    """
+    selection = {
+        'latitude': slice(request['latitude_range'][0], request['latitude_range'][1]),
+    }
+    if 'level' in xarr.dims:  # surface variables have no level
+        selection['level'] = slice(request['level_range'][0], request['level_range'][1])
+    xarr = xarr.sel(**selection)
+
+    longitude = _convert_longitude(xarr.longitude.values, request['longitude_shift'])
+    positions = _longitude_positions(longitude, request['longitude_range'])
+    xarr = xarr.isel(longitude=positions)
+    return xarr.assign_coords(longitude=longitude[positions])
+
+
+def _convert_longitude(longitude, longitude_shift):
+    """
+    Convert the longitude to 0~360 if longitude_shift, otherwise to -180~180.
+    """
+    if longitude_shift:
+        return longitude % 360
+    return ((longitude + 180) % 360) - 180
+
+
+def _longitude_positions(longitude, longitude_range):
+    """
+    Find the positions of the longitudes in longitude_range, ordered eastward from its first value.
+
+    Args:
+        longitude (np.ndarray): The longitudes, in the same convention as longitude_range.
+        longitude_range (tuple): (west, east), crossing 0 or 180 if west > east.
+
+    Returns:
+        slice or np.ndarray: A slice if the positions are contiguous, otherwise the positions.
+    """
+    west, east = longitude_range
+    if west <= east:
+        in_range = (longitude >= west) & (longitude <= east)
+    else:
+        in_range = (longitude >= west) | (longitude <= east)
+    positions = np.flatnonzero(in_range)
+    positions = positions[np.argsort((longitude[positions] - west) % 360, kind='stable')]
+    if len(positions) > 0 and (np.diff(positions) == 1).all():
+        return slice(positions[0], positions[-1] + 1)
+    return positions
+
+
+def _longitude_range_length(longitude_range):
+    west, east = longitude_range
+    return east - west if west <= east else (east - west) % 360
+
+
 def _calculate_cache_expire_date():
     """
     Calculate the cache expire date and return the datetime object and string.
@@ -255,27 +1807,270 @@ def _calculate_cache_expire_date():
     return cache_expire_date, cache_expire_date_str
 
 
-def _cache_file_exist(cache_name):
-    cache_file_list = [file for file in os.listdir(cache_era5_folder) if file.startswith(cache_name)]
-    return len(cache_file_list) > 0
+# [cache manifest]
+# the manifest records every cache file with its request, size, last access and expire date,
+# so looking up and removing cache files does not need to list the cache folder
+_manifest_entry_columns = (
+    'cache_name', 'path', 'size', 'last_access', 'expire',
+    'from_datetime', 'to_datetime', 'time_interval', 'variables',
+    'level_lo', 'level_hi', 'lat_hi', 'lat_lo', 'lon_lo', 'lon_hi', 'longitude_shift',
+    'aggregation', 'target_grid',
+)
+# columns added after the first version of the manifest, added to older manifests when connecting
+_manifest_added_columns = {
+    'aggregation': "TEXT DEFAULT ''",
+    'target_grid': "TEXT DEFAULT ''",
+}
+
+
+_manifest_checked_paths = set()
+
+
+def _manifest_connection():
+    """
+    Connect to the cache manifest, create it if not exists.
+    """
+    manifest_path = os.path.join(cache_era5_folder, 'manifest.sqlite')
+    connection = sqlite3.connect(manifest_path, timeout=60)
+    if manifest_path not in _manifest_checked_paths:
+        # once per process, the file may be created but still empty by another process
+        _create_manifest(connection)
+        _manifest_checked_paths.add(manifest_path)
+    return _ManifestConnection(connection)
+
+
+class _ManifestConnection:
+    """
+    Commit (or rollback on error) and close the sqlite connection when leaving the `with` block.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            self.connection.close()
+
+
+def _create_manifest(connection):
+    with connection:
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS cache_entries ('
+            'cache_name TEXT PRIMARY KEY, path TEXT, size INTEGER, last_access REAL, expire REAL, '
+            'from_datetime TEXT, to_datetime TEXT, time_interval INTEGER, variables TEXT, '
+            'level_lo REAL, level_hi REAL, lat_hi REAL, lat_lo REAL, lon_lo REAL, lon_hi REAL, longitude_shift INTEGER'
+            + ''.join(f', {column} {column_type}' for column, column_type in _manifest_added_columns.items()) + ')'
+        )
+        existing_columns = {row[1] for row in connection.execute('PRAGMA table_info(cache_entries)')}
+        for column, column_type in _manifest_added_columns.items():
+            if column not in existing_columns:
+                try:
+                    connection.execute(f'ALTER TABLE cache_entries ADD COLUMN {column} {column_type}')
+                except sqlite3.OperationalError:  # added by another process at the same time
+                    pass
+        connection.execute('CREATE INDEX IF NOT EXISTS cache_entries_expire ON cache_entries (expire)')
+        connection.execute('CREATE INDEX IF NOT EXISTS cache_entries_last_access ON cache_entries (last_access)')
+        connection.execute('CREATE INDEX IF NOT EXISTS cache_entries_time ON cache_entries (longitude_shift, from_datetime, to_datetime)')
+
+    # cache files written before the manifest existed kept the expire date in their name, they can't be looked up anymore
+    for cache_file in os.listdir(cache_era5_folder):
+        expire_date_str = cache_file.split('_')[-1].split('.')[0]
+        if cache_file.endswith('.nc') and len(expire_date_str) == 14 and expire_date_str.isdigit():
+            _remove_cache_file(os.path.join(cache_era5_folder, cache_file))
+
+
+def _register_cache_file(cache_name, path):
+    entry = _cache_entry_from_name(cache_name)
+    cache_expire_date, _ = _calculate_cache_expire_date()
+    with _manifest_connection() as connection:
+        connection.execute(
+            f'INSERT OR REPLACE INTO cache_entries ({", ".join(_manifest_entry_columns)}) VALUES ({", ".join("?" * len(_manifest_entry_columns))})',
+            (
+                cache_name, path, _cache_file_size(path), time.time(), cache_expire_date.timestamp(),
+                entry['from_datetime'].strftime('%Y%m%d%H'), entry['to_datetime'].strftime('%Y%m%d%H'), entry['time_interval'], '-'.join(entry['variable_list']),
+                entry['level_range'][0], entry['level_range'][1],
+                entry['latitude_range'][0], entry['latitude_range'][1],
+                entry['longitude_range'][0], entry['longitude_range'][1],
+                entry['longitude_shift'],
+                entry['aggregation'], entry['target_grid'],
+            ),
+        )
+
+
+# [cache locks]
+# a fixed number of lock stripes shared by the cache names, so that the locks never grow with the cache,
+# each stripe is a threading lock for the threads of this process and a file lock for the other processes
+_cache_lock_stripes = 256
+_cache_thread_locks = [threading.Lock() for _ in range(_cache_lock_stripes)]
+
+
+def _cache_lock_stripe(cache_name):
+    """
+    Give the lock stripe of the cache name.
+    """
+    return int(hashlib.sha1(cache_name.encode()).hexdigest(), 16) % _cache_lock_stripes
+
+
+def _cache_lock(cache_name, blocking=True):
+    """
+    Lock the cache name, as a context manager which gives whether the lock is acquired.
+
+    Args:
+        cache_name (str): The cache name of the request.
+        blocking (bool): If False, don't wait and give False when the lock is held by another caller.
+    """
+    return _cache_stripe_lock(_cache_lock_stripe(cache_name), blocking)
+
+
+def _cache_stripe_lock(stripe, blocking=True):
+    """
+    Lock the lock stripe, the stripe is not reentrant, so lock each stripe once and in increasing order when holding many.
+    """
+    lock_path = os.path.join(cache_era5_folder, 'locks', f"{stripe:03d}.lock")
+    return _CacheLock(_cache_thread_locks[stripe], lock_path, blocking)
+
+
+class _CacheLock:
+    def __init__(self, thread_lock, lock_path, blocking):
+        self.thread_lock = thread_lock
+        self.lock_path = lock_path
+        self.blocking = blocking
+        self.lock_file = None
+
+    def __enter__(self):
+        if not self.thread_lock.acquire(blocking=self.blocking):
+            return False
+        try:
+            os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+            self.lock_file = open(self.lock_path, 'a+b')
+            if not _lock_file(self.lock_file, self.blocking):
+                self.lock_file.close()
+                self.lock_file = None
+                self.thread_lock.release()
+                return False
+        except BaseException:
+            if self.lock_file is not None:
+                self.lock_file.close()
+                self.lock_file = None
+            self.thread_lock.release()
+            raise
+        return True
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.lock_file is None:
+            return
+        try:
+            _unlock_file(self.lock_file)
+        finally:
+            self.lock_file.close()
+            self.lock_file = None
+            self.thread_lock.release()
+
+
+def _lock_file(lock_file, blocking):
+    """
+    Lock the opened file exclusively, return False if not blocking and it is locked by another process.
+    """
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+    lock_file.seek(0)
+    while True:
+        try:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            if not blocking:
+                return False
+            time.sleep(0.1)
+
+
+def _unlock_file(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _cache_entry_from_row(row):
+    row = dict(zip(_manifest_entry_columns, row))
+    return {
+        'cache_name': row['cache_name'],
+        'path': row['path'],
+        'from_datetime': datetime.datetime.strptime(row['from_datetime'], '%Y%m%d%H'),
+        'to_datetime': datetime.datetime.strptime(row['to_datetime'], '%Y%m%d%H'),
+        'time_interval': row['time_interval'],
+        'variable_list': row['variables'].split('-'),
+        'level_range': (row['level_lo'], row['level_hi']),
+        'latitude_range': (row['lat_hi'], row['lat_lo']),
+        'longitude_range': (row['lon_lo'], row['lon_hi']),
+        'longitude_shift': bool(row['longitude_shift']),
+        'aggregation': row['aggregation'],
+        'target_grid': row['target_grid'],
+    }
+
+
+def _touch_cache_entry(cache_name):
+    """
+    Update the last access time and extend the expire date of the cache entry.
+    """
+    cache_expire_date, _ = _calculate_cache_expire_date()
+    with _manifest_connection() as connection:
+        connection.execute('UPDATE cache_entries SET last_access = ?, expire = ? WHERE cache_name = ?', (time.time(), cache_expire_date.timestamp(), cache_name))
 
 
 def _cache_file_path(cache_name):
-    cache_file_list = [file for file in os.listdir(cache_era5_folder) if file.startswith(cache_name)]
-    return os.path.join(cache_era5_folder, cache_file_list[0])
+    with _manifest_connection() as connection:
+        row = connection.execute('SELECT path FROM cache_entries WHERE cache_name = ?', (cache_name,)).fetchone()
+    return row[0]
 
 
-def _get_cache_file_xarr(cache_name):
-    cache_file_path = _cache_file_path(cache_name)
-    xarr = xarray.open_dataset(cache_file_path, engine='netcdf4')
-    return xarr
+def _cache_file_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(folder, file)) for folder, _, files in os.walk(path) for file in files)  # zarr folder
+
+
+def _remove_cache_file(path):
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)  # zarr folder
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
 
 
-def _rename_cache_file(cache_name, expire_date_str):
+# HDF5 is not thread safe, and xarray only locks the reads and writes of an opened file, not the opening and closing,
+# so the cache netcdf files are opened, written, and loaded and closed by `iter_era5_windows`, under this lock
+_netcdf_lock = threading.RLock()
+
+
+def _get_cache_file_xarr(cache_name):
     cache_file_path = _cache_file_path(cache_name)
-    new_cache_file_name = f"{cache_name}_{expire_date_str}.nc"
-    new_cache_file_path = os.path.join(cache_era5_folder, new_cache_file_name)
-    os.rename(cache_file_path, new_cache_file_path)
+    if cache_file_path.endswith('.zarr'):
+        xarr = xarray.open_zarr(cache_file_path, chunks=None)
+    else:
+        with _netcdf_lock:
+            xarr = xarray.open_dataset(cache_file_path, engine='netcdf4')
+
+    # packed variables are read as float32 like the era5 data, xarray decodes int16 from zarr to float64 because
+    # zarr keeps scale_factor as a json number, and doesn't decode float16
+    packed_names = [name for name, variable in xarr.data_vars.items() if variable.encoding.get('dtype') in (np.int16, np.float16) and variable.dtype != np.float32]
+    if packed_names:
+        xarr = xarr.assign({name: xarr[name].astype('float32') for name in packed_names})
+    return xarr
 
 
 # [check functions]
@@ -284,9 +2079,9 @@ def _variable_list_should_be_list(variable_list: list) -> None:
         raise ValueError(f"variable_list should be a list, but got {type(variable_list)}")
 
 
-def _all_var_should_be_in_era5_dataset_var_list(full_era5: xarray.Dataset, variable_list: list) -> None:
+def _all_var_should_be_in_era5_dataset_var_list(era5_variables: dict, variable_list: list) -> None:
     for variable in variable_list:
-        if variable not in full_era5.data_vars:
+        if variable not in era5_variables:
             raise ValueError(f"variable {variable} is not in the era5 dataset, if you want to check the variables, please run `metorology.era5_downloader.show_era5_variables()`")
 
 
@@ -391,3 +2186,127 @@ def _longitude_range_adjustment(longitude_range):
 def _time_interval_should_be_positive(time_interval):
     if time_interval <= 0:
         raise ValueError(f"data_steps should be greater than 0, but got {time_interval}")
+
+
+def _block_hours_should_be_positive_int_or_month(block_hours):
+    if block_hours != 'month' and (not isinstance(block_hours, int) or block_hours <= 0):
+        raise ValueError(f"block_hours should be a positive int or 'month', but got {block_hours}")
+
+
+def _archive_should_exist(archive_path):
+    if not os.path.exists(archive_path):
+        raise ValueError(f"archive_path should be an existing netcdf file or zarr folder, but {archive_path} does not exist")
+
+
+def _archive_should_not_be_packed(archive, archive_path):
+    packed_variables = [
+        name for name, variable in archive.data_vars.items()
+        if 'scale_factor' in variable.encoding or str(variable.encoding.get('dtype', variable.dtype)) in ('int16', 'float16')
+    ]
+    if packed_variables:
+        raise ValueError(f"archive_path should not be packed, but {packed_variables} of {archive_path} are packed as int16 or float16, save the archive again with packing=None before syncing it")
+
+
+def _block_hours_should_be_positive_int(block_hours):
+    if not isinstance(block_hours, int) or block_hours <= 0:
+        raise ValueError(f"block_hours should be a positive int, but got {block_hours}")
+
+
+def _points_should_have_same_length(latitudes, longitudes, station_ids):
+    if len(latitudes) != len(longitudes) or (station_ids is not None and len(station_ids) != len(latitudes)):
+        raise ValueError(f"latitudes, longitudes and station_ids should have the same length, but got {len(latitudes)}, {len(longitudes)} and {None if station_ids is None else len(station_ids)}")
+    if len(latitudes) == 0:
+        raise ValueError("latitudes and longitudes should not be empty")
+
+
+def _point_latitudes_should_in_valid_range(latitudes):
+    if latitudes.min() < -90 or latitudes.max() > 90:
+        raise ValueError(f"latitudes should be in GCS ERA5 data set valid range(-90, 90), but got latitudes from {latitudes.min()} to {latitudes.max()}")
+
+
+def _method_should_be_nearest_or_linear(method):
+    if method not in ('nearest', 'linear'):
+        raise ValueError(f"method should be 'nearest' or 'linear', but got {method}")
+
+
+def _save_at_should_be_netcdf_or_zarr(save_at):
+    if not isinstance(save_at, str):
+        raise ValueError(f"save_at should be a string, but got {type(save_at)}")
+    if not save_at.lower().endswith('.nc') and not save_at.lower().endswith('.zarr'):
+        raise ValueError(f"save_at should be a '.nc' file or a '.zarr' folder, but got {save_at}")
+
+
+def _max_workers_should_be_positive_int(max_workers):
+    if not isinstance(max_workers, int) or max_workers <= 0:
+        raise ValueError(f"max_workers should be a positive int, but got {max_workers}")
+
+
+def _prefetch_should_be_non_negative_int(prefetch):
+    if not isinstance(prefetch, int) or prefetch < 0:
+        raise ValueError(f"prefetch should be a non-negative int, but got {prefetch}")
+
+
+def _prefetch_workers_should_be_positive_int(prefetch_workers):
+    if not isinstance(prefetch_workers, int) or prefetch_workers <= 0:
+        raise ValueError(f"prefetch_workers should be a positive int, but got {prefetch_workers}")
+
+
+def _worker_memory_bytes_should_be_positive_int(worker_memory_bytes):
+    if not isinstance(worker_memory_bytes, int) or worker_memory_bytes <= 0:
+        raise ValueError(f"worker_memory_bytes should be a positive int, but got {worker_memory_bytes}")
+
+
+def _aggregation_should_be_none_or_valid_dict(aggregation):
+    if aggregation is None:
+        return
+    if not isinstance(aggregation, dict) or set(aggregation) != {'freq', 'reducers'}:
+        raise ValueError(f"aggregation should be None or a dict with 'freq' and 'reducers', but got {aggregation}")
+    freq = aggregation['freq']
+    if freq not in ('daily', 'monthly') and not (isinstance(freq, int) and not isinstance(freq, bool) and freq > 0):
+        raise ValueError(f"aggregation['freq'] should be 'daily', 'monthly' or a positive int of hours, but got {freq}")
+    reducers = aggregation['reducers']
+    if not isinstance(reducers, (list, tuple)) or len(reducers) == 0 or not set(reducers).issubset(_aggregation_reducers):
+        raise ValueError(f"aggregation['reducers'] should be a non-empty list of {_aggregation_reducers}, but got {reducers}")
+
+
+def _lazy_should_not_be_with_aggregation_or_regrid(lazy, aggregation, target_resolution):
+    if lazy and aggregation is not None:
+        raise ValueError("lazy and aggregation can't be used together, aggregate the lazy dataset with xarray's resample instead")
+    if lazy and target_resolution is not None:
+        raise ValueError("lazy and target_resolution can't be used together, coarsen the lazy dataset with xarray's coarsen instead")
+
+
+def _target_resolution_should_be_none_or_multiple_of_era5_resolution(target_resolution, era5_resolution):
+    if target_resolution is None:
+        return
+    if isinstance(target_resolution, bool) or not isinstance(target_resolution, (int, float)) or target_resolution < era5_resolution:
+        raise ValueError(f"target_resolution should be None or a number not smaller than the era5 resolution ({era5_resolution}), but got {target_resolution}")
+    factor = target_resolution / era5_resolution
+    if abs(factor - round(factor)) > 1e-6:
+        raise ValueError(f"target_resolution should be a multiple of the era5 resolution ({era5_resolution}), but got {target_resolution}")
+    cells_around = 360 / (round(factor) * era5_resolution)
+    if abs(cells_around - round(cells_around)) > 1e-6:
+        raise ValueError(f"target_resolution should divide 360, so that the coarse grid wraps around the globe, but got {target_resolution}")
+
+
+def _regrid_method_should_be_block_mean_or_conservative(regrid_method):
+    if regrid_method not in ('block_mean', 'conservative'):
+        raise ValueError(f"regrid_method should be 'block_mean' or 'conservative', but got {regrid_method}")
+
+
+def _lazy_chunk_multiple_should_be_positive_int(lazy_chunk_multiple):
+    if not isinstance(lazy_chunk_multiple, int) or lazy_chunk_multiple <= 0:
+        raise ValueError(f"lazy_chunk_multiple should be a positive int, but got {lazy_chunk_multiple}")
+
+
+def _requests_should_be_list_of_dict(requests):
+    if not isinstance(requests, list) or not all(isinstance(request, dict) for request in requests):
+        raise ValueError(f"requests should be a list of dict, but got {type(requests)}")
+
+
+def _request_keys_should_be_supported_by_download_many(requests):
+    supported_keys = set(inspect.signature(_check_request).parameters) | {'max_workers', 'worker_memory_bytes'}
+    for i, request in enumerate(requests):
+        unsupported_keys = sorted(set(request) - supported_keys)
+        if len(unsupported_keys) > 0:
+            raise ValueError(f"requests should only hold the arguments supported by download_many, {sorted(supported_keys)}, but got {unsupported_keys} in requests[{i}]")
@@ -0,0 +1,204 @@
+import collections
+import contextlib
+import contextvars
+import functools
+import threading
+import time
+import tracemalloc
+
+# config
+trace_memory = False  # if True, measure the peak memory of each call with tracemalloc, which slows the call down
+
+# [counters]
+# Prometheus style counters, (name, labels) -> value, labels is a tuple of (label, value)
+counters = collections.Counter()
+_counters_lock = threading.Lock()
+_counter_help = {
+    'quick_era5_calls_total': 'Calls of the instrumented functions.',
+    'quick_era5_call_seconds_total': 'Seconds spent in the instrumented functions.',
+    'quick_era5_phase_seconds_total': 'Seconds spent in each phase of the instrumented functions.',
+    'quick_era5_cache_hits_total': 'Requests answered from the cache.',
+    'quick_era5_cache_misses_total': 'Requests not in the cache.',
+    'quick_era5_cache_evictions_total': 'Cache files removed because they expired or the cache is too large.',
+    'quick_era5_chunks_fetched_total': 'Zarr chunks fetched from the era5 store.',
+    'quick_era5_bytes_fetched_total': 'Bytes of the zarr chunks fetched from the era5 store.',
+    'quick_era5_chunk_cache_hits_total': 'Zarr chunks read from the chunk cache.',
+    'quick_era5_chunk_cache_misses_total': 'Zarr chunks not in the chunk cache.',
+    'quick_era5_files_written_total': 'Files written by the converter.',
+    'quick_era5_import_seconds_total': 'Seconds spent importing quick_era5 and its dependencies, which are imported on first use.',
+}
+
+# [import cost]
+# seconds spent importing quick_era5 and each dependency imported on first use, e.g. {'quick_era5': 0.01, 'xarray': 0.54}
+import_seconds = {}
+
+_callbacks = []
+_current_report = contextvars.ContextVar('quick_era5_current_report', default=None)
+_last_report = threading.local()
+
+
+class CallReport:
+    """
+    The timings and counts of one call of an instrumented function, e.g. `download_era5_data_from_gcs`.
+
+    Attributes:
+        function (str): The name of the function.
+        seconds (float): The wall time of the call.
+        phases (dict): Seconds spent in each phase, e.g. {'metadata': 0.01, 'cache_lookup': 0.002, 'fetch': 3.2}.
+        counts (dict): Counts of the call, e.g. {'cache_misses': 1, 'chunks_fetched': 48, 'bytes_fetched': 123456}.
+        peak_memory_bytes (int or None): The peak memory traced by tracemalloc, None if `trace_memory` is False.
+        error (str or None): The error raised by the call, None if it succeeded.
+    """
+    def __init__(self, function):
+        self.function = function
+        self.seconds = 0.0
+        self.phases = collections.defaultdict(float)
+        self.counts = collections.Counter()
+        self.peak_memory_bytes = None
+        self.error = None
+        self._lock = threading.Lock()
+
+    def as_dict(self) -> dict:
+        return {
+            'function': self.function,
+            'seconds': self.seconds,
+            'phases': dict(self.phases),
+            'counts': dict(self.counts),
+            'peak_memory_bytes': self.peak_memory_bytes,
+            'error': self.error,
+        }
+
+    def __repr__(self):
+        return f"CallReport({self.as_dict()})"
+
+
+def add_callback(callback) -> None:
+    """
+    Call `callback(report)` with the CallReport at the end of every instrumented call, e.g. to send the metrics to a monitoring system.
+
+    Args:
+        callback (callable): Takes a CallReport.
+    Returns:
+        None
+    """
+    _callbacks.append(callback)
+
+
+def remove_callback(callback) -> None:
+    _callbacks.remove(callback)
+
+
+def last_report() -> CallReport | None:
+    """
+    The CallReport of the last instrumented call finished in this thread, None if there is none.
+    """
+    return getattr(_last_report, 'report', None)
+
+
+def prometheus_text() -> str:
+    """
+    The counters in the Prometheus text exposition format, e.g. to serve them at a /metrics endpoint.
+    """
+    with _counters_lock:
+        items = sorted(counters.items())
+    lines = []
+    written_names = set()
+    for (name, labels), value in items:
+        if name not in written_names:
+            lines.append(f"# HELP {name} {_counter_help.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            written_names.add(name)
+        label_text = ','.join(f'{label}="{label_value}"' for label, label_value in labels)
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def reset() -> None:
+    """
+    Reset the counters to zero.
+    """
+    with _counters_lock:
+        counters.clear()
+
+
+# [instrumentation used by the other modules]
+def count(name, value=1):
+    """
+    Add value to the counter `quick_era5_{name}_total` and to the report of the current call.
+    """
+    _add_counter(f"quick_era5_{name}_total", (), value)
+    report = _current_report.get()
+    if report is not None:
+        with report._lock:
+            report.counts[name] += value
+
+
+def count_import(module_name, seconds):
+    """
+    Record the seconds spent importing a module in `import_seconds` and the counter `quick_era5_import_seconds_total`.
+    """
+    import_seconds[module_name] = seconds
+    _add_counter('quick_era5_import_seconds_total', (('module', module_name),), seconds)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Time the block as a phase of the current call.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _add_counter('quick_era5_phase_seconds_total', (('phase', name),), seconds)
+        report = _current_report.get()
+        if report is not None:
+            with report._lock:
+                report.phases[name] += seconds
+
+
+def instrument(func):
+    """
+    Make a CallReport for every call of func. A call inside another instrumented call reports into the outer call.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _current_report.get() is not None:
+            return func(*args, **kwargs)
+
+        report = CallReport(func.__name__)
+        token = _current_report.set(report)
+        tracing = trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except BaseException as e:
+            report.error = repr(e)
+            raise
+        finally:
+            report.seconds = time.perf_counter() - start
+            if tracing:
+                _, report.peak_memory_bytes = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            _current_report.reset(token)
+            _add_counter('quick_era5_calls_total', (('function', report.function),), 1)
+            _add_counter('quick_era5_call_seconds_total', (('function', report.function),), report.seconds)
+            _last_report.report = report
+            for callback in list(_callbacks):
+                callback(report)
+    return wrapper
+
+
+def run_in_context(executor, func, *args):
+    """
+    Submit func to the executor in a copy of the current context, so that the worker thread reports into the current call.
+    """
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+def _add_counter(name, labels, value):
+    with _counters_lock:
+        counters[(name, labels)] += value